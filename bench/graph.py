@@ -0,0 +1,218 @@
+#! /usr/bin/python3
+
+""" Benchmark whole GoodMake builds of a synthetic dependency graph.
+
+Generates a make script with one stanza per target, in layers of depth
+targets above a layer of source files.  Each target depends on fan-in
+targets of the layer below, spread so that each has about fan-out parents.
+
+Measures a cold serial build, a no-op rebuild, a rebuild after changing
+one source file, and a cold parallel build.  Each reports wall and CPU
+time, processes, bytes hashed, and peak RSS, as JSON.
+
+Usage: bench/graph.py [options] [-o results.json]
+"""
+
+import argparse
+import json
+import os
+import os.path as path
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+theRoot = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, theRoot)
+
+import goodmake  # noqa: E402
+
+theGoodMake = path.join(theRoot, 'goodmake.py')
+
+
+def layers(nodes: int, depth: int, fanin: int, fanout: int) -> List[int]:
+    """ Widths of each layer, sources first, summing to about nodes. """
+    # Each layer is fanin / fanout times as wide as the one above
+    ratios = [(fanin / fanout) ** (depth - k) for k in range(depth + 1)]
+    widths = [max(1, round(nodes * r / sum(ratios))) for r in ratios]
+    # Every target needs fanin distinct dependencies
+    for k in range(1, len(widths)):
+        widths[k - 1] = max(widths[k - 1], fanin)
+    return widths
+
+
+def node(layer: int, index: int) -> str:
+    return 'src/n%d' % index if layer == 0 else 't%d/n%d' % (layer, index)
+
+
+def generate(dirPath: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """ Write the source files and make script.  Returns a description of the graph. """
+    rand = random.Random(args.seed)
+    widths = layers(args.nodes, args.depth, args.fanin, args.fanout)
+
+    os.makedirs(path.join(dirPath, 'src'))
+    for i in range(widths[0]):
+        with open(path.join(dirPath, node(0, i)), 'wb') as source:
+            source.write(rand.getrandbits(8 * args.size).to_bytes(args.size, 'little'))
+
+    cost = '    sleep %g\n' % args.cost if args.cost > 0 else ''
+    edges = 0
+
+    with open(path.join(dirPath, 'make.sh'), 'w') as script:
+        script.write('#! %s /bin/sh -se\n\n#? !default\n    $0 %s\n' % (
+            theGoodMake, ' '.join(node(args.depth, i) for i in range(widths[-1]))
+        ))
+        for k in range(1, len(widths)):
+            # Round-robin over the layer below, so fan-out is even
+            below = list(range(widths[k - 1]))
+            rand.shuffle(below)
+            for i in range(widths[k]):
+                deps = [node(k - 1, below[(i * args.fanin + j) % len(below)]) for j in range(args.fanin)]
+                edges += len(deps)
+                script.write('\n#? %s\n    $0 %s\n%s    cat %s | md5sum >$1\n' % (
+                    node(k, i), ' '.join(deps), cost, ' '.join(deps)
+                ))
+    os.chmod(path.join(dirPath, 'make.sh'), 0o755)
+
+    return {
+        'layers': widths,
+        'nodes': sum(widths),
+        'edges': edges,
+        'sourceBytes': widths[0] * args.size,
+    }
+
+
+def run(dirPath: str, threads: int) -> Dict[str, Any]:
+    """ Build the default target, and measure it and all its descendant processes. """
+    traceDir = tempfile.mkdtemp(prefix='trace-', dir=dirPath)
+    env = dict(os.environ)
+    for name in list(env):
+        if name.startswith('GM_'):
+            del env[name]
+    env.update({
+        goodmake.theThreadsName: str(threads),
+        goodmake.theTraceName: traceDir,
+        goodmake.theCacheName: path.join(dirPath, '.cache'),
+        goodmake.theLogName: 'ERROR',
+    })
+
+    with open(path.join(dirPath, 'build.log'), 'ab') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, theGoodMake, '/bin/sh', './make.sh'],
+            cwd=dirPath, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+        # wait4 gives the rusage of this build alone, including reaped grandchildren
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        raise RuntimeError('Build failed (%d), see %s' % (process.returncode, log.name))
+
+    traces = [name for name in os.listdir(traceDir) if name.endswith('.json')]
+    with open(path.join(traceDir, traces[0]), 'r') as trace:
+        events = json.load(trace)['traceEvents']
+    shutil.rmtree(traceDir)
+
+    return {
+        'wall': wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'user': usage.ru_utime,
+        'system': usage.ru_stime,
+        'goodmakeProcesses': len(set(e['pid'] for e in events)),
+        'recipes': sum(1 for e in events if e['cat'] == 'run'),
+        'checks': sum(1 for e in events if e['cat'] == 'check'),
+        'filesHashed': sum(1 for e in events if e['cat'] == 'hash'),
+        'bytesHashed': sum(e['args'].get('bytes', 0) for e in events if e['cat'] == 'hash'),
+        # Largest single process, in KiB on Linux
+        'peakRSS': usage.ru_maxrss,
+    }
+
+
+def scenarios(dirPath: str, args: argparse.Namespace) -> Dict[str, Dict[str, Any]]:
+    """ One run of each scenario, on a freshly generated tree. """
+    results = {}
+    results['cold'] = run(dirPath, 1)
+    results['noop'] = run(dirPath, 1)
+
+    with open(path.join(dirPath, node(0, 0)), 'ab') as source:
+        source.write(b'\n')
+    results['leaf'] = run(dirPath, 1)
+
+    for name in os.listdir(dirPath):
+        if re.match(r't\d+$', name) or name == '.cache':
+            shutil.rmtree(path.join(dirPath, name))
+        elif name.endswith('.gm'):
+            os.remove(path.join(dirPath, name))
+    results['parallel'] = run(dirPath, args.threads)
+    return results
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--nodes', type=int, default=200, help='Total sources and targets')
+    parser.add_argument('--depth', type=int, default=4, help='Layers of targets above the sources')
+    parser.add_argument('--fanin', type=int, default=3, help='Dependencies of each target')
+    parser.add_argument('--fanout', type=int, default=3, help='Approximate parents of each node')
+    parser.add_argument('--size', type=int, default=65536, help='Bytes in each source file')
+    parser.add_argument('--cost', type=float, default=0, help='Seconds each recipe sleeps')
+    parser.add_argument('--threads', type=int, default=8, help='GM_THREADS for the parallel build')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each scenario; the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dir', help='Build here instead of in a temporary directory')
+    parser.add_argument('-o', '--output', help='Write JSON results here instead of to stdout')
+    args = parser.parse_args(argv[1:])
+
+    root = args.dir or tempfile.mkdtemp(prefix='goodmake-bench-')
+    best: Dict[str, Dict[str, Any]] = {}
+    try:
+        for repeat in range(args.repeat):
+            dirPath = path.join(root, 'run%d' % repeat)
+            graph = generate(dirPath, args)
+            for name, result in scenarios(dirPath, args).items():
+                if name not in best or result['wall'] < best[name]['wall']:
+                    best[name] = result
+            if not args.dir:
+                shutil.rmtree(dirPath)
+    finally:
+        if not args.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    for name, result in best.items():
+        print('%-9s %8.3f s wall %8.3f s cpu %5d processes %10d bytes hashed %8d KiB RSS' % (
+            name, result['wall'], result['cpu'], result['goodmakeProcesses'] + result['recipes'],
+            result['bytesHashed'], result['peakRSS'],
+        ), file=sys.stderr)
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=theRoot, stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    report = {
+        'version': goodmake.theVersion,
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {k: v for k, v in vars(args).items() if k not in ['dir', 'output']},
+        'graph': graph,
+        'scenarios': best,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text)
+    else:
+        sys.stdout.write(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
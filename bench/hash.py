@@ -0,0 +1,64 @@
+#! /usr/bin/python3
+
+""" Benchmark GoodMake file hashing throughput, per algorithm.
+
+Usage: bench/hash.py [size_mb [repeat]]
+"""
+
+from functools import partial
+import hashlib
+import os
+import os.path as path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import goodmake  # noqa: E402
+
+
+def legacyHash(target: str) -> str:
+    """ The original path: md5 over 4 KiB reads. """
+    d = hashlib.md5()
+    with open(target, mode='rb') as f:
+        for buf in iter(partial(f.read, 4096), b''):
+            d.update(buf)
+    return d.hexdigest()
+
+
+def engineHash(algorithm: str, target: str) -> str:
+    goodmake.theHash = algorithm
+    return goodmake.hashFile(target)
+
+
+def measure(name: str, hasher: partial, target: str, size: int, repeat: int) -> None:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hasher(target)
+        best = min(best, time.perf_counter() - start)
+    print('%-14s %8.1f MB/s' % (name, size / best / 1e6))
+
+
+def main(argv: list) -> int:
+    sizeMB = int(argv[1]) if len(argv) > 1 else 256
+    repeat = int(argv[2]) if len(argv) > 2 else 5
+    size = sizeMB << 20
+
+    with tempfile.NamedTemporaryFile() as data:
+        chunk = os.urandom(1 << 20)
+        for _ in range(sizeMB):
+            data.write(chunk)
+        data.flush()
+
+        print('Hashing %d MB, best of %d (warm page cache)' % (sizeMB, repeat))
+        measure('md5 (legacy)', partial(legacyHash), data.name, size, repeat)
+        for algorithm in goodmake.theHashes:
+            measure(algorithm, partial(engineHash, algorithm), data.name, size, repeat)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
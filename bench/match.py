@@ -0,0 +1,100 @@
+#! /usr/bin/python3
+
+""" Benchmark Script.match against the original linear fnmatch loop.
+
+Usage: bench/match.py [stanzas [lookups]]
+"""
+
+import fnmatch
+import os.path as path
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import goodmake  # noqa: E402
+
+
+def linearMatch(script: goodmake.Script, target: str) -> tuple:
+    """ The original matcher: every pattern of every stanza, in order. """
+    result = None
+    always, ignore, generic = False, False, True
+    for patterns, shebang, stanza in script._stanzas:
+        for p in patterns.split():
+            bang = p.startswith('!')
+            if fnmatch.fnmatch(target, p if not bang else p[1:]):
+                result = result + stanza if result else stanza
+                always = always or shebang
+                ignore = ignore or bang
+                generic = generic and p == '*'
+                break
+    return (result if not generic else None, always, ignore)
+
+
+def writeScript(file: tempfile._TemporaryFileWrapper, count: int) -> None:
+    """ A generated make script, mostly literal targets like real generated scripts. """
+    file.write('#! goodmake.py /bin/sh -se\n\n#? *\n    true\n')
+    for i in range(count):
+        kind = i % 10
+        if kind < 6:
+            patterns = 'out/file%d.o !phony%d' % (i, i)
+        elif kind < 8:
+            patterns = 'gen%d/*' % i
+        elif kind < 9:
+            patterns = '*.ext%d' % i
+        else:
+            patterns = 'dir%d/*/[ab]?.c' % i
+        file.write('#%s %s\n    echo %d\n' % ('!' if i % 7 == 0 else '?', patterns, i))
+    file.flush()
+
+
+def targets(count: int, lookups: int) -> list:
+    rand = random.Random(0)
+    choices = [
+        lambda i: 'out/file%d.o' % i,
+        lambda i: 'phony%d' % i,
+        lambda i: 'gen%d/x/y.h' % i,
+        lambda i: 'src/thing.ext%d' % i,
+        lambda i: 'dir%d/sub/a1.c' % i,
+        lambda i: 'no/such/target%d' % i,
+    ]
+    return [rand.choice(choices)(rand.randrange(count)) for _ in range(lookups)]
+
+
+def measure(name: str, fn: object, lookups: list) -> float:
+    start = time.perf_counter()
+    for target in lookups:
+        fn(target)  # type: ignore
+    elapsed = time.perf_counter() - start
+    print('%-22s %10.1f us/lookup' % (name, elapsed / len(lookups) * 1e6))
+    return elapsed
+
+
+def main(argv: list) -> int:
+    count = int(argv[1]) if len(argv) > 1 else 3000
+    lookups = targets(count, int(argv[2]) if len(argv) > 2 else 2000)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.sh') as file:
+        writeScript(file, count)
+        start = time.perf_counter()
+        script = goodmake.Script(file.name)
+        print('Parsed and indexed %d stanzas in %.1f ms' % (
+            count, (time.perf_counter() - start) * 1e3
+        ))
+
+    for target in set(lookups):
+        recipe = script._match(target)
+        expected = linearMatch(script, target)
+        assert (recipe.script, recipe.always, recipe.ignore) == expected, target
+
+    linear = measure('linear fnmatch', lambda t: linearMatch(script, t), lookups)
+    indexed = measure('indexed', script._match, lookups)
+    measure('indexed + LRU', script.match, lookups)
+    print('Speedup (uncached): %.0fx' % (linear / indexed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
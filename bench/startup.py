@@ -0,0 +1,142 @@
+#! /usr/bin/python3
+
+""" Benchmark the startup cost of nested GoodMake invocations.
+
+Every $0 dependency runs GoodMake again, so its startup is multiplied by
+the edges of the build graph.  Measures the import time of goodmake, and
+the wall time of a nested invocation for a target already checked this
+build, and for one that is up to date but not yet checked.
+
+Nested invocations run goodmake like the installed `goodmake` command,
+which imports the module from cached bytecode.  Running goodmake.py as a
+script would compile all of it on every run.
+
+Exits with status 1 if the import, or an invocation for a checked target,
+takes longer than its budget in milliseconds.
+
+Usage: bench/startup.py [--repeat N] [--import-budget MS] [--budget MS]
+"""
+
+import argparse
+import os
+import os.path as path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+theRoot = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, theRoot)
+
+import goodmake  # noqa: E402
+
+# Like the console script that setup.py installs
+theLauncher = '''#! %(python)s
+import sys
+sys.path.insert(0, %(root)r)
+import goodmake
+sys.exit(goodmake.main())
+'''
+
+# The first build makes the targets, and the second times checking them
+theScript = '''#! %(launcher)s /bin/sh -se
+
+#? !make
+    $0 checked %(targets)s
+
+#! !time
+    $0 checked
+    $0 time-checked
+    $0 time-uptodate
+
+#! !time-checked
+    start=$(date +%%s%%N)
+    for i in $(seq %(repeat)d); do $0 checked; done
+    echo $(( ($(date +%%s%%N) - start) / %(repeat)d )) >time-checked
+
+#! !time-uptodate
+    start=$(date +%%s%%N)
+    for t in %(targets)s; do $0 $t; done
+    echo $(( ($(date +%%s%%N) - start) / %(repeat)d )) >time-uptodate
+
+#? checked dep*
+    echo $1 >$1
+'''
+
+
+def environment(dirPath: str) -> Dict[str, str]:
+    """ A clean environment that caches bytecode. """
+    env = {k: v for k, v in os.environ.items() if not k.startswith('GM_')}
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env.update({
+        goodmake.theCacheName: path.join(dirPath, '.cache'),
+        goodmake.theLogName: 'ERROR',
+    })
+    return env
+
+
+def importTime(dirPath: str, repeat: int) -> float:
+    """ Fastest cumulative import of goodmake, in ms, from python -X importtime. """
+    best = float('inf')
+    for _ in range(repeat):
+        report = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import goodmake'],
+            cwd=theRoot, env=environment(dirPath), stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+            check=True,
+        ).stderr.decode('utf-8')
+        match = re.search(r'^import time:\s+\d+ \|\s+(\d+) \| goodmake$', report, re.MULTILINE)
+        if match:
+            best = min(best, int(match.group(1)) / 1000)
+    return best
+
+
+def nestedTimes(dirPath: str, repeat: int) -> Dict[str, float]:
+    """ Mean ms of nested invocations for checked and up-to-date targets. """
+    launcher = path.join(dirPath, 'goodmake')
+    with open(launcher, 'w') as script:
+        script.write(theLauncher % {'python': sys.executable, 'root': theRoot})
+    os.chmod(launcher, 0o755)
+
+    targets = ' '.join('dep%d' % i for i in range(repeat))
+    with open(path.join(dirPath, 'make.sh'), 'w') as script:
+        script.write(theScript % {'launcher': launcher, 'targets': targets, 'repeat': repeat})
+    os.chmod(path.join(dirPath, 'make.sh'), 0o755)
+
+    for target in ['make', 'time']:
+        subprocess.run(['./make.sh', target], cwd=dirPath, env=environment(dirPath), check=True)
+
+    times = {}
+    for name in ['checked', 'uptodate']:
+        with open(path.join(dirPath, 'time-' + name), 'r') as result:
+            times[name] = int(result.read()) / 1e6
+    return times
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--repeat', type=int, default=20, help='Invocations of each kind to time')
+    parser.add_argument('--import-budget', type=float, default=60, help='Most ms to import goodmake')
+    parser.add_argument('--budget', type=float, default=120, help='Most ms for a checked target')
+    args = parser.parse_args(argv[1:])
+
+    dirPath = tempfile.mkdtemp(prefix='goodmake-startup-')
+    try:
+        imported = importTime(dirPath, 5)
+        times = nestedTimes(dirPath, args.repeat)
+    finally:
+        shutil.rmtree(dirPath)
+
+    print('import goodmake   %8.1f ms (budget %g)' % (imported, args.import_budget))
+    print('checked target    %8.1f ms (budget %g)' % (times['checked'], args.budget))
+    print('up-to-date target %8.1f ms' % times['uptodate'])
+
+    if imported > args.import_budget or times['checked'] > args.budget:
+        print('Over budget', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
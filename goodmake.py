@@ -7,34 +7,113 @@
 
 # from __future__ import annotations  # For Python 3.7+
 
-from concurrent.futures import ThreadPoolExecutor as ThreadPool
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 from datetime import datetime, timedelta
-from enum import Enum
-from functools import partial
-from random import random
-from typing import Any, cast, Dict, Generator, Iterable, List, Match, Optional, Tuple
+from functools import lru_cache, partial
+from array import array
+from typing import (
+    Any, Callable, cast, Dict, Generator, IO, Iterable, Iterator, List, Match, Optional, Set,
+    Tuple, TYPE_CHECKING, Union,
+)
+import fcntl
 import fnmatch
 import hashlib
+import importlib
 import logging
 import os
 import os.path as path
 import re
-import subprocess
+import select
+import signal
+import stat
+import struct
 import sys
 import threading
 import time
 
 logger = logging.getLogger()
 
+
+class LazyModule:
+
+    """ A module imported when first used.
+
+    Most nested invocations only find their targets already checked, and
+    one runs for every $0 dependency, so they don't import the modules for
+    running recipes, daemons, or databases until they need them. """
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, name: str) -> Any:
+        module = importlib.import_module(self._name)
+        # Later lookups find the module's attributes without calling us
+        self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ThreadPoolExecutor as ThreadPool
+    import asyncio
+    import base64
+    import concurrent.futures as futures
+    import ctypes
+    import ctypes.util as ctypesUtil
+    import hmac
+    import json
+    import pickle
+    import random
+    import shutil
+    import socket
+    import sqlite3
+    import subprocess
+    import tempfile
+else:
+    asyncio = LazyModule('asyncio')
+    base64 = LazyModule('base64')
+    futures = LazyModule('concurrent.futures')
+    ctypes = LazyModule('ctypes')
+    ctypesUtil = LazyModule('ctypes.util')
+    hmac = LazyModule('hmac')
+    json = LazyModule('json')
+    pickle = LazyModule('pickle')
+    random = LazyModule('random')
+    shutil = LazyModule('shutil')
+    socket = LazyModule('socket')
+    sqlite3 = LazyModule('sqlite3')
+    subprocess = LazyModule('subprocess')
+    tempfile = LazyModule('tempfile')
+
 theVersion = '0.2.0'
 
+theArtifactsName = 'GM_ARTIFACTS'
+theArtifactsLinkName = 'GM_ARTIFACTS_LINK'
+theArtifactsSizeName = 'GM_ARTIFACTS_SIZE'
+theAsyncName = 'GM_ASYNC'
+theBatchName = 'GM_BATCH'
+theCacheName = 'GM_CACHE'
+theChainName = 'GM_CHAIN'
+theDaemonName = 'GM_DAEMON'
+theDatabaseName = 'GM_DATABASE'
 theDepName = 'GM_FILE'
+theHashName = 'GM_HASH'
+theIgnoreName = 'GM_IGNORE'
+theJobServerName = 'GM_JOBSERVER'
 theLogName = 'LOG'
+theMaxLoadName = 'GM_MAX_LOAD'
+theMaxPressureName = 'GM_MAX_PRESSURE'
+theParallelCheckName = 'GM_PARALLEL_CHECK'
+thePrewarmName = 'GM_PREWARM'
 theRemakeName = 'GM_REMAKE'
+theScriptCacheName = 'GM_SCRIPTCACHE'
+theStatCacheName = 'GM_STATCACHE'
+theTargetName = 'GM_TARGET'
 theTimeoutName = 'GM_TIMEOUT'
 theTimestampName = 'GM_STARTTIME'
 theThreadsName = 'GM_THREADS'
+theTraceName = 'GM_TRACE'
+theWorkersName = 'GM_WORKERS'
+theWorkerTokenName = 'GM_WORKER_TOKEN'
 
 ################ TYPES ####################
 
@@ -47,15 +126,26 @@ Hash = str
 Seconds = float
 ShellCommand = List[str]
 
+# Stanza index, position in the stanza's pattern list, "!" flag, and pattern
+StanzaPattern = Tuple[int, int, bool, str]
+
+# Directory entry names with their lstats
+DirEntries = List[Tuple[str, os.stat_result]]
+# Paths with their modification times
+Stamped = List[Tuple[FullPath, float]]
+
+try:
+    import xxhash  # type: ignore
+except ImportError:
+    xxhash = None
+
 ###########################################
 
-# Rough maximum wait for goodmake file locks, in seconds
+# Wait for goodmake file locks before warning, in seconds
 theLockWait: Seconds = int(os.environ.get(theTimeoutName, 60))
 
-# Number of retries during wait
-theLockTries = 10
-
 theDateFormat = '%Y-%m-%dT%H:%M:%S.%f'
+theDatePattern = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)\.(\d{6})$')
 theDebugLogFormat = '%(filename)s[%(lineno)d]: %(message)s'
 theLogFormat = '%(message)s'
 
@@ -63,9 +153,90 @@ theStampAccuracy = timedelta(0, 0, 10000)
 
 theMaxThreads = int(os.environ.get(theThreadsName, 8))
 
+# Directory for caches shared between builds
+theCacheDir = cast(FullPath, os.environ.get(theCacheName) or path.join(
+    cast(FullPath, os.environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache')), 'goodmake'
+))
+
+# Files modified this recently may still change without changing their stat
+theRacyWindow: Seconds = 2
+
+# The stat cache keeps its entries in this many files, each trimmed to its newest half
+# past this size
+theStatBuckets = 256
+theStatBucketSize = 1 << 16
+
+# Checksum algorithms, by name
+theHashes: Dict[str, Callable[[], Any]] = {
+    'md5': hashlib.md5,
+    'blake2b': partial(hashlib.blake2b, digest_size=16),
+}
+if xxhash is not None:
+    theHashes.update({
+        'xxh3': xxhash.xxh3_128,
+        'xxh64': xxhash.xxh64,
+    })
+
+theHash = os.environ.get(theHashName, 'md5')
+
+# Size of the per-thread buffer for reading files to hash
+theReadSize = 1 << 20
+
+# Names left out of directory checksums: GoodMake's own files, and GM_IGNORE
+theIgnore = ['.*.gm', '.*.gm.*'] + os.environ.get(theIgnoreName, '').split()
+
+# Number of recipe lookups remembered by each script
+theMatchCache = 4096
+
+# Resolved paths to remember, since build logs repeat the same few directories
+thePathCache = 65536
+
+# Build logs are read back from the end this many bytes at a time, to find the target's line
+theTailRead = 4096
+
+# Number of targets listed in each section of a trace summary
+theTraceTop = 20
+
+# Size limit of the artifact cache, in MiB, and earlier builds kept for each target
+theArtifactsSize = float(os.environ.get(theArtifactsSizeName, 10240))
+theArtifactEntries = 8
+
+# ioctl to clone a file's extents on copy-on-write filesystems (btrfs, xfs)
+theFICLONE = 0x40049409
+
+# Recipes waiting for the load to drop check it this often
+theAdmitInterval: Seconds = 1
+
+# Binary suffixes of resource sizes, like "+mem=4G"
+theSizeSuffixes = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# The asyncio engine checks at most this many dependencies at once, and the rest inline
+theAsyncChecks = 4096
+
+# --clean checks and deletes this many build logs at a time
+theCleanBatch = 1024
+
+# --watch waits for changes to stop arriving for this long before building
+theWatchDelay: Seconds = 0.05
+theWatchMaxDelay: Seconds = 1
+
+# Seconds to wait for a worker to answer, and longest wait before retrying full workers
+theWorkerTimeout: Seconds = 5
+theWorkerRetry: Seconds = 1
+
 ###########################################
 
-def date2str(timestamp: datetime = None) -> str:
+def env2bool(name: str, default: bool = False) -> bool:
+    return os.environ.get(name, str(default)).lower() in ['true', 'yes', '1', 'on']
+
+
+def resolve(future: 'asyncio.Future', result: Any) -> None:
+    """ Set the result of future, unless it's already done. """
+    if not future.done():
+        future.set_result(result)
+
+
+def date2str(timestamp: Optional[datetime] = None) -> str:
     if timestamp is None:
         return 'None'
     return datetime.strftime(timestamp, theDateFormat)
@@ -74,9 +245,15 @@ def date2str(timestamp: datetime = None) -> str:
 def str2date(timestamp: str) -> datetime:
     if timestamp == 'now':
         return datetime.now()
-    return datetime.strptime(timestamp, theDateFormat)
+    # Much faster than strptime, which also imports locale support on first use
+    match = theDatePattern.match(timestamp)
+    if match is None:
+        return datetime.strptime(timestamp, theDateFormat)
+    year, month, day, hour, minute, second, microsecond = map(int, match.groups())
+    return datetime(year, month, day, hour, minute, second, microsecond)
 
 
+@lru_cache(maxsize=thePathCache)
 def str2path(text: str, dirPath: FullPath) -> FullPath:
     return path.normpath(path.join(dirPath, text))
 
@@ -89,16 +266,354 @@ def path2str(fullPath: FullPath, dirPath: FullPath) -> str:
     return relPath
 
 
-def hashString(str: str) -> Hash:
-    return hashBuffers([str.encode('utf-8')])
+def hashString(str: str, algorithm: Optional[str] = None) -> Hash:
+    return hashBuffers([str.encode('utf-8')], algorithm)
 
 
-def hashBuffers(buffers: Iterable[bytes]) -> Hash:
-    d = hashlib.md5()
+def hashBuffers(buffers: Iterable[bytes], algorithm: Optional[str] = None) -> Hash:
+    d = theHashes[algorithm or theHash]()
     for buf in buffers:
         d.update(buf)
-    return d.hexdigest()
+    return cast(Hash, d.hexdigest())
+
+
+_theBuffers = threading.local()
+
+
+def hashFile(target: FullPath) -> Hash:
+    """ Hash a file through a reused buffer, to avoid a syscall and allocation per 4K. """
+    buf = getattr(_theBuffers, 'buf', None)
+    if buf is None:
+        buf = _theBuffers.buf = bytearray(theReadSize)
+    view = memoryview(buf)
+
+    d = theHashes[theHash]()
+    with open(target, mode='rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            d.update(view[:size])
+    return cast(Hash, d.hexdigest())
+
+
+def listDirectory(dirPath: FullPath, ignore: List[str]) -> DirEntries:
+    """ Sorted names and lstats of a directory's entries, except names matching ignore. """
+    try:
+        with os.scandir(dirPath) as scan:
+            entries = [
+                (entry.name, entry.stat(follow_symlinks=False)) for entry in scan
+                if not any(fnmatch.fnmatch(entry.name, p) for p in ignore)
+            ]
+    except OSError as e:
+        logger.debug('Not listing %s: %s', dirPath, e)
+        return []
+    return sorted(entries)
+
+
+def listTree(
+    pool: 'ThreadPool', tops: List[FullPath], ignore: List[str]
+) -> Dict[FullPath, DirEntries]:
+    """ Entries of every directory under tops, listed a level at a time on pool. """
+    listings: Dict[FullPath, DirEntries] = {}
+    level = tops
+    while level:
+        found = list(pool.map(partial(listDirectory, ignore=ignore), level))
+        listings.update(zip(level, found))
+        level = [
+            path.join(dirPath, name) for dirPath, entries in zip(level, found)
+            for name, st in entries if stat.S_ISDIR(st.st_mode)
+        ]
+    return listings
+
+
+###########################################
+
+class StatCache:
+
+    """ On-disk map from file stat fingerprints to checksums.
+
+    A file is only re-hashed when its (device, inode, size, mtime, ctime)
+    changes.  Like git's index, files changed within theRacyWindow of being
+    hashed are not cached, since a second write in the same clock tick would
+    leave the fingerprint unchanged.  A directory is keyed by the
+    fingerprints of everything under it.
+
+    Entries are lines appended to one of theStatBuckets files.  A bucket
+    that grows past theStatBucketSize keeps only its newest half, so the
+    whole cache stays under a few MiB. """
+
+    def __init__(self, dirPath: Optional[FullPath]):
+        self.dirPath = dirPath
+
+    @staticmethod
+    def fingerprint(st: os.stat_result) -> str:
+        return '%d:%d:%d:%d:%d' % (
+            st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+        )
+
+    @staticmethod
+    def racy(st: os.stat_result) -> bool:
+        return time.time() - max(st.st_mtime, st.st_ctime) < theRacyWindow
+
+    def get(self, st: os.stat_result) -> Optional[Hash]:
+        return self.getKey(self._key(st))
+
+    def getKey(self, key: str) -> Optional[Hash]:
+        """ Checksum cached for key, such as a directory's from directoryKey. """
+        if self.dirPath is None:
+            return None
+
+        try:
+            with open(self._bucket(key), 'r') as bucket:
+                text = '\n' + bucket.read()
+        except OSError:
+            return None
+
+        # The newest entry wins, and a line still being appended doesn't count
+        start = text.rfind('\n%s ' % key)
+        end = text.find('\n', start + 1)
+        if start < 0 or end < 0:
+            return None
+        return text[start + len(key) + 2:end] or None
+
+    def put(self, target: FullPath, st: os.stat_result, checksum: Hash) -> None:
+        if self.dirPath is None:
+            return
+
+        if StatCache.racy(st):
+            logger.debug('Not caching racy %s', target)
+            return
+
+        try:
+            # Don't cache a checksum of a file that changed while hashing
+            if self.fingerprint(os.stat(target)) != self.fingerprint(st):
+                return
+        except OSError as e:
+            logger.debug('Not caching %s: %s', target, e)
+            return
+
+        self.putKey(target, self._key(st), checksum)
+
+    def putKey(self, target: FullPath, key: str, checksum: Hash) -> None:
+        if self.dirPath is None:
+            return
 
+        try:
+            bucket = self._bucket(key)
+            try:
+                fd = os.open(bucket, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+            except FileNotFoundError:
+                os.makedirs(path.dirname(bucket), exist_ok=True)
+                # Before buckets, each entry had its own file
+                shutil.rmtree(path.join(self.dirPath, 'stat'), ignore_errors=True)
+                fd = os.open(bucket, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+            try:
+                # One short write, so concurrent appends don't interleave
+                os.write(fd, ('%s %s\n' % (key, checksum)).encode('utf-8'))
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+
+            if size > theStatBucketSize:
+                self._trim(bucket)
+        except OSError as e:
+            logger.debug('Not caching %s: %s', target, e)
+
+    @staticmethod
+    def _trim(bucket: FullPath) -> None:
+        """ Keep the newest half of a bucket.  Entries appended meanwhile may be lost. """
+        with open(bucket, 'r') as file:
+            lines = file.readlines()
+        temp = cast(FullPath, '%s.%d.%d' % (bucket, os.getpid(), threading.get_ident()))
+        with open(temp, 'w') as file:
+            file.writelines(line for line in lines[len(lines) // 2:] if line.endswith('\n'))
+        os.replace(temp, bucket)
+
+    def _key(self, st: os.stat_result) -> str:
+        return hashString(theHash + ' ' + self.fingerprint(st), 'md5')
+
+    def directoryKey(self, entries: List[str]) -> str:
+        """ Key for a directory, from a line for each entry with its fingerprint. """
+        return hashString(theHash + ' directory\0' + ''.join(entries), 'md5')
+
+    def _bucket(self, key: str) -> FullPath:
+        return path.join(
+            cast(FullPath, self.dirPath), 'checksums', '%02x' % (int(key[:4], 16) % theStatBuckets)
+        )
+
+
+theStatCache = StatCache(theCacheDir if env2bool(theStatCacheName, True) else None)
+
+
+class Span:
+
+    """ Times one phase of the build, if GM_TRACE is set. """
+
+    def __init__(self, phase: str, target: str, script: str, start: Optional[float] = None):
+        self.phase = phase
+        self.args: Dict[str, Any] = {'target': target, 'script': script}
+        self.start = start
+
+    def __enter__(self) -> 'Span':
+        if Trace.enabled():
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if self.start is not None:
+            if exc[0] is not None:
+                self.args['error'] = str(exc[1])
+            Trace.write(self, time.time())
+
+
+class Trace:
+
+    """ Chrome trace_event timeline of a build, in GM_TRACE.
+
+    Every process of a build appends its spans as JSON lines to one file
+    named from GM_STARTTIME.  The top-level build merges them into a
+    .json file for chrome://tracing, and a .txt summary. """
+
+    _lock = threading.Lock()
+    _fd: Optional[int] = None
+    _pid: Optional[int] = None
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(os.environ.get(theTraceName))
+
+    @staticmethod
+    def span(phase: str, target: str = '', script: str = '') -> Span:
+        return Span(phase, target, script)
+
+    @staticmethod
+    def path(timestamp: str) -> FullPath:
+        name = re.sub(r'[^0-9A-Za-z]+', '-', timestamp)
+        return path.join(cast(FullPath, os.environ[theTraceName]), 'goodmake-' + name)
+
+    @staticmethod
+    def write(span: Span, end: float) -> None:
+        event = {
+            'name': span.phase + ' ' + span.args['target'] if span.args['target'] else span.phase,
+            'cat': span.phase,
+            'ph': 'X',
+            'ts': int(cast(float, span.start) * 1e6),
+            'dur': int((end - cast(float, span.start)) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': span.args,
+        }
+        line = (json.dumps(event) + '\n').encode('utf-8')
+
+        with Trace._lock:
+            # Forked daemon children need their own descriptor
+            if Trace._pid != os.getpid():
+                tracePath = Trace.path(os.environ.get(theTimestampName, 'None'))
+                os.makedirs(path.dirname(tracePath), exist_ok=True)
+                Trace._fd = os.open(
+                    tracePath + '.jsonl', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666
+                )
+                Trace._pid = os.getpid()
+            # One write per line, so lines from other processes don't interleave
+            os.write(cast(int, Trace._fd), line)
+
+    @staticmethod
+    def startup() -> None:
+        """ Record the interpreter startup of this process, on Linux. """
+        if not Trace.enabled():
+            return
+        try:
+            with open('/proc/self/stat', 'r') as stats:
+                ticks = int(stats.read().rsplit(')', 1)[1].split()[19])
+            with open('/proc/uptime', 'r') as uptime:
+                age = float(uptime.read().split()[0]) - ticks / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError):
+            return
+        now = time.time()
+        Trace.write(Span('startup', '', '', now - max(age, 0)), now)
+
+    @staticmethod
+    def merge(timestamp: str) -> None:
+        """ Write the .json trace and .txt summary for the build. """
+        tracePath = Trace.path(timestamp)
+        try:
+            with open(tracePath + '.jsonl', 'r') as lines:
+                events = [json.loads(line) for line in lines]
+        except FileNotFoundError:
+            return
+
+        with open(tracePath + '.json', 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+        with open(tracePath + '.txt', 'w') as summary:
+            summary.write(Trace.summarize(timestamp, events))
+        os.remove(cast(FullPath, tracePath + '.jsonl'))
+        logger.warning('Wrote trace to %s.json', tracePath)
+
+    @staticmethod
+    def summarize(timestamp: str, events: List[Dict[str, Any]]) -> str:
+        """ Time per phase, slowest targets, and the critical path. """
+        phases: Dict[str, int] = {}
+        for event in events:
+            phases[event['cat']] = phases.get(event['cat'], 0) + event['dur']
+
+        # Each target's longest build span, and the build spans of its dependencies
+        builds: Dict[str, Dict[str, Any]] = {}
+        children: Dict[str, List[Dict[str, Any]]] = {}
+        for event in events:
+            if event['cat'] != 'build' or 'info' not in event['args']:
+                continue
+            info = event['args']['info']
+            if info not in builds or builds[info]['dur'] < event['dur']:
+                builds[info] = event
+            children.setdefault(event['args']['parent'], []).append(event)
+
+        def end(event: Dict[str, Any]) -> int:
+            return int(event['ts'] + event['dur'])
+
+        def exclusive(event: Dict[str, Any]) -> int:
+            """ Time not spent building dependencies, which may overlap. """
+            covered, reached = 0, event['ts']
+            for child in sorted(children.get(event['args']['info'], []), key=lambda e: e['ts']):
+                start, stop = max(child['ts'], reached), min(end(child), end(event))
+                if stop > start:
+                    covered += stop - start
+                    reached = stop
+            return int(event['dur'] - covered)
+
+        def line(micros: int, text: str) -> str:
+            return '%10.3f s  %s\n' % (micros / 1e6, text)
+
+        start = min((e['ts'] for e in events), default=0)
+        stop = max((end(e) for e in events), default=0)
+        text = 'GoodMake build %s: %.3f s, %d spans in %d processes\n' % (
+            timestamp, (stop - start) / 1e6, len(events), len(set(e['pid'] for e in events))
+        )
+
+        text += '\nTime in each phase, summed over threads:\n'
+        for phase, micros in sorted(phases.items(), key=lambda p: -p[1]):
+            text += line(micros, phase)
+
+        text += '\nSlowest targets, excluding their dependencies:\n'
+        slowest = sorted(builds.values(), key=exclusive, reverse=True)[:theTraceTop]
+        for event in slowest:
+            text += line(
+                exclusive(event), '%s (%s)' % (event['args']['target'], event['args']['script'])
+            )
+
+        # Later spans of a target are often just "checked this build"
+        text += '\nCritical path, following the longest dependency build:\n'
+        roots = [e for e in builds.values() if e['args']['parent'] not in builds]
+        node = max(roots, key=lambda e: e['dur'], default=None)
+        seen: Set[str] = set()
+        depth = 0
+        while node is not None and node['args']['info'] not in seen:
+            seen.add(node['args']['info'])
+            text += line(node['dur'], '  ' * depth + node['args']['target'])
+            node = max(children.get(node['args']['info'], []), key=lambda e: e['dur'], default=None)
+            depth += 1
+
+        return text
 
 ###########################################
 
@@ -109,6 +624,9 @@ class BuildError(Exception):
 
 
 class BuildCommand:
+    # Aggregate targets can record tens of thousands of dependencies
+    __slots__ = ['dirPath', 'script', 'target']
+
     def __init__(self, dirPath: FullPath, scriptPath: str, targetPath: str):
         self.dirPath = dirPath
         self.script = scriptPath
@@ -124,78 +642,173 @@ class BuildCommand:
 
 
 class Recipe:
-    def __init__(self, interpreter: ShellCommand, script: Optional[str], always: bool, ignore: bool):
+    def __init__(
+        self, interpreter: ShellCommand, script: Optional[str], always: bool, ignore: bool,
+        memory: int = 0, batch: bool = False, outputs: Optional[List[str]] = None,
+    ):
         self.interpreter = interpreter
         self.script = script
         self.always = always
         self.ignore = ignore
-
-    def run(recipe, command: BuildCommand, vars: dict) -> None:
-        if recipe.script is None:
-            raise BuildError("No recipe for " + command.target)
-
-        env = os.environ.copy()
-        env.update(vars)
-
-        description = '%s %s (with %s)' % (
-            command.script, command.target, ' '.join(recipe.interpreter)
-        )
-
-        logger.debug('Running %s', description)
+        # Bytes of memory the recipe declares it uses
+        self.memory = memory
+        # Whether one run can make many targets, and the targets every run makes
+        self.batch = batch
+        self.outputs = outputs or []
+        self.stanza: Optional[Hash] = None
+
+    def run(
+        recipe, command: BuildCommand, vars: dict, targets: Optional[List[str]] = None,
+        workers: Optional['WorkerPool'] = None,
+    ) -> None:
+        """ Run the recipe for command, or with targets as its only arguments.
+
+        Runs it on workers, if there are any. """
+        args, env, description = recipe._prepare(command, vars, targets)
+
+        if workers is not None:
+            returncode = workers.run(
+                command.dirPath, args, recipe, env, targets or [command.target]
+            )
+            if returncode is not None:
+                recipe._finish(description, returncode)
+                return
 
         process = subprocess.Popen(
-            [command.script] + recipe.interpreter[1:] + [command.target, command.script],
+            args,
             executable=recipe.interpreter[0],
             stdin=subprocess.PIPE,
             env=env,
             cwd=command.dirPath,
         )
 
+        Builder.started(process)
         try:
-            process.stdin.write(recipe.script.encode('utf-8'))
-            process.stdin.close()
-            while process.poll() is None:
-                Builder.sleep(.1)
+            stdin = cast(IO[bytes], process.stdin)
+            stdin.write(cast(str, recipe.script).encode('utf-8'))
+            stdin.close()
+            process.wait()
+            Builder.sleep(0)
         finally:
+            Builder.finished(process)
             process.kill()
             process.wait()
 
-        if process.returncode != 0:
-            logger.debug('Raising %s (%d)', description, process.returncode)
+        recipe._finish(description, process.returncode)
+
+    async def runAsync(
+        recipe, command: BuildCommand, vars: dict, targets: Optional[List[str]] = None
+    ) -> None:
+        """ Like run, in an asyncio subprocess. """
+        args, env, description = recipe._prepare(command, vars, targets)
+
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            executable=recipe.interpreter[0],
+            stdin=asyncio.subprocess.PIPE,
+            env=env,
+            cwd=command.dirPath,
+        )
+
+        Builder.started(process)
+        try:
+            stdin = cast('asyncio.StreamWriter', process.stdin)
+            stdin.write(cast(str, recipe.script).encode('utf-8'))
+            await stdin.drain()
+            stdin.close()
+            await process.wait()
+            Builder.sleep(0)
+        finally:
+            Builder.finished(process)
+            if process.returncode is None:
+                Builder._kill(process)
+                await process.wait()
+
+        recipe._finish(description, process.returncode)
+
+    def _prepare(
+        recipe, command: BuildCommand, vars: dict, targets: Optional[List[str]]
+    ) -> Tuple[List[str], Dict[str, str], str]:
+        """ Arguments, environment, and description of a run. """
+        if recipe.script is None:
+            raise BuildError("No recipe for " + command.target)
+
+        env = os.environ.copy()
+        # These only apply to the batch recipe that set them, not to its dependencies
+        for name in [theBatchName, theTargetName]:
+            env.pop(name, None)
+        env.update(vars)
+
+        description = '%s %s (with %s)' % (
+            command.script, ' '.join(targets or [command.target]), ' '.join(recipe.interpreter)
+        )
+
+        logger.debug('Running %s', description)
+
+        args = [command.script] + recipe.interpreter[1:]
+        args += targets or [command.target, command.script]
+        return args, env, description
+
+    @staticmethod
+    def _finish(description: str, returncode: Optional[int]) -> None:
+        if returncode != 0:
+            logger.debug('Raising %s (%s)', description, returncode)
             raise BuildError(
-                "%s returned %d" % (description, process.returncode),
-                process.returncode,
+                "%s returned %s" % (description, returncode),
+                cast(int, returncode),
             )
 
 
 class BuildEvent(BuildCommand):
+    __slots__ = ['stanza', 'timestamp', 'checksum', 'duration', 'critical']
 
     @staticmethod
     def fromString(line: str, dirPath: FullPath) -> 'BuildEvent':
-        args = line.rstrip().split('\t')
-        return BuildEvent(BuildCommand(str2path(args[0], dirPath), *args[1:3]), *args[3:])
+        args = line.rstrip('\n').split('\t')
+        event = BuildEvent(
+            BuildCommand(str2path(args[0], dirPath), sys.intern(args[1]), args[2]), *args[3:6]
+        )
+        # Logs written before recipes were timed have no durations
+        if len(args) > 7:
+            event.duration = float(args[6]) if args[6] else None
+            event.critical = float(args[7]) if args[7] else None
+        return event
 
     @staticmethod
     def fromRecipe(command: BuildCommand, recipe: Recipe) -> 'BuildEvent':
         stanza = BuildEvent._hashStanza(recipe)
         return BuildEvent(command, stanza)
 
+    # Older logs recorded 'directory' instead of checksumming directories
     nonsums = ['directory', 'ignore']
-    header = ['directory', 'script', 'target', 'recipe', 'timestamp', 'result']
+    header = [
+        'directory', 'script', 'target', 'recipe', 'timestamp', 'result', 'duration', 'critical'
+    ]
+
+    # Last column of the header line: file format and checksum algorithm
+    version = 'gm1'
+    legacyFormat = 'gm1:md5'
+
+    @staticmethod
+    def format() -> str:
+        return BuildEvent.version + ':' + theHash
 
     def __init__(
         self,
         command: BuildCommand,
         stanza: Hash,
-        timestamp: str = None,
-        checksum: Hash = None
+        timestamp: Optional[str] = None,
+        checksum: Optional[Hash] = None
     ):
         super(BuildEvent, self).__init__(command.dirPath, command.script, command.target)
         self.stanza = stanza
         self.timestamp = timestamp
         self.checksum = checksum
+        # Seconds the recipe ran, and the longest chain of recipes ending with it
+        self.duration: Optional[Seconds] = None
+        self.critical: Optional[Seconds] = None
 
-    def refresh(self, timestamp: datetime = None, ignoreChecksum: bool = False) -> None:
+    def refresh(self, timestamp: Optional[datetime] = None, ignoreChecksum: bool = False) -> None:
         self.timestamp = date2str(timestamp)
         self.checksum = (
             'ignore' if ignoreChecksum
@@ -210,6 +823,8 @@ class BuildEvent(BuildCommand):
             self.stanza,
             self.timestamp or '',
             self.checksum or '',
+            '' if self.duration is None else '%.3f' % self.duration,
+            '' if self.critical is None else '%.3f' % self.critical,
         ])
 
     @staticmethod
@@ -219,21 +834,346 @@ class BuildEvent(BuildCommand):
         elif not recipe.script:
             return 'empty'
 
-        return hashString(recipe.script)
+        # Recipes are shared by Script.match's cache, so hash each once
+        if recipe.stanza is None:
+            recipe.stanza = hashString(recipe.script)
+        return recipe.stanza
 
     @staticmethod
     def _hashFile(target: FullPath) -> Hash:
-        if not path.exists(target):
+        try:
+            st = os.stat(target)
+        except OSError:
             return 'missing'
 
-        if path.isdir(target):
-            return 'directory'
+        if stat.S_ISDIR(st.st_mode):
+            with Trace.span('hash', target):
+                return BuildEvent._hashDirectory(target)
 
-        if path.getsize(target) == 0:
+        if st.st_size == 0:
             return 'empty'
 
-        with open(target, mode='rb') as f:
-            return hashBuffers(iter(partial(f.read, 4096), b''))
+        checksum = theStatCache.get(st)
+        if checksum is None:
+            with Trace.span('hash', target) as span:
+                span.args['bytes'] = st.st_size
+                checksum = hashFile(target)
+            theStatCache.put(target, st, checksum)
+        return checksum
+
+    @staticmethod
+    def _hashDirectory(target: FullPath) -> Hash:
+        """ Merkle checksum of the names, modes, contents, and symlinks under a directory.
+
+        Each directory's checksum is cached by the fingerprints of everything
+        under it, so only directories with changes below them are hashed again. """
+        with futures.ThreadPoolExecutor(max_workers=theMaxThreads) as pool:
+            listings = listTree(pool, [target], theIgnore)
+
+            # Deepest directories first, so each one's subdirectories are done
+            order = sorted(listings, key=lambda d: -d.count(os.sep))
+            keys: Dict[FullPath, str] = {}
+            racy: Set[FullPath] = set()
+            for dirPath in order:
+                lines = []
+                for name, st in listings[dirPath]:
+                    fullPath = path.join(dirPath, name)
+                    if stat.S_ISDIR(st.st_mode):
+                        fingerprint = keys[fullPath]
+                        isRacy = fullPath in racy
+                    else:
+                        fingerprint = StatCache.fingerprint(st)
+                        isRacy = StatCache.racy(st)
+                    if isRacy:
+                        racy.add(dirPath)
+                    lines.append('%o\0%s\0%s\0' % (st.st_mode, name, fingerprint))
+                keys[dirPath] = theStatCache.directoryKey(lines)
+
+            hashes: Dict[FullPath, Hash] = {}
+            cached = theStatCache.getKey(keys[target])
+            if cached is not None:
+                return cached
+
+            # Shallowest first, skipping the directories under a cached one
+            changed = [target]
+            for dirPath in changed:
+                for name, st in listings[dirPath]:
+                    fullPath = path.join(dirPath, name)
+                    if stat.S_ISDIR(st.st_mode):
+                        cached = theStatCache.getKey(keys[fullPath])
+                        if cached is None:
+                            changed.append(fullPath)
+                        else:
+                            hashes[fullPath] = cached
+
+            # Unchanged files get their checksums from the stat cache
+            files = [
+                path.join(dirPath, name) for dirPath in changed
+                for name, st in listings[dirPath] if stat.S_ISREG(st.st_mode)
+            ]
+            checksums = dict(zip(files, pool.map(BuildEvent._hashFile, files)))
+
+        for dirPath in reversed(changed):
+            entries = []
+            for name, st in listings[dirPath]:
+                fullPath = path.join(dirPath, name)
+                if stat.S_ISDIR(st.st_mode):
+                    content = hashes[fullPath]
+                elif stat.S_ISREG(st.st_mode):
+                    content = checksums[fullPath]
+                elif stat.S_ISLNK(st.st_mode):
+                    content = os.readlink(fullPath)
+                else:
+                    content = ''
+                entries.append('%o\0%s\0%s\0' % (st.st_mode, name, content))
+            hashes[dirPath] = hashString(''.join(entries))
+            if dirPath not in racy:
+                theStatCache.putKey(dirPath, keys[dirPath], hashes[dirPath])
+        return hashes[target]
+
+
+class InfoFiles:
+
+    """ Keeps the build info of each target in a dotfile beside it. """
+
+    def journal(self, filename: FullPath) -> FullPath:
+        return filename
+
+    def lockname(self, filename: FullPath) -> FullPath:
+        return cast(FullPath, filename + '.lock')
+
+    def read(self, filename: FullPath) -> Optional[Tuple[List[str], float]]:
+        """ Returns the lines of the info, and when it was last checked. """
+        try:
+            with open(filename, 'r') as info:
+                return info.readlines(), os.fstat(info.fileno()).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def deps(self, filename: FullPath) -> Iterator[str]:
+        """ The dependency lines of the info, read one at a time as they're used. """
+        try:
+            info = open(filename, 'r')
+        except FileNotFoundError:
+            return
+        with info:
+            info.readline()
+            # Each line but the last, which is the target's own
+            previous = None
+            for line in info:
+                if previous is not None:
+                    yield previous
+                previous = line
+
+    def ends(self, filename: FullPath) -> Optional[Tuple[str, str, float]]:
+        """ The header and last lines of the info, and when it was last checked.
+
+        The last line is found by reading back from the end, so checks that
+        only need the target's line don't read all its dependencies. """
+        try:
+            with open(filename, 'rb') as info:
+                header = info.readline()
+                checked = os.fstat(info.fileno()).st_mtime
+                position = info.seek(0, os.SEEK_END)
+                tail = b''
+                while position > len(header):
+                    size = min(theTailRead, position - len(header))
+                    position -= size
+                    info.seek(position)
+                    tail = info.read(size) + tail
+                    # Skip the newline ending the last line
+                    newline = tail.rfind(b'\n', 0, len(tail) - 1)
+                    if newline >= 0:
+                        tail = tail[newline + 1:]
+                        break
+                return header.decode('utf-8'), tail.decode('utf-8'), checked
+        except FileNotFoundError:
+            return None
+
+    def commit(self, filename: FullPath) -> None:
+        """ Save the journal, or mark an existing info as checked now. """
+        if path.exists(filename):
+            os.utime(filename)
+
+    def remove(self, filename: FullPath) -> None:
+        if path.exists(filename):
+            os.remove(filename)
+
+    def scan(self, pool: 'ThreadPool', dirPaths: List[FullPath]) -> Tuple[Stamped, Stamped]:
+        """ Infos and lock files under dirPaths, with when each was last modified. """
+        infos: Stamped = []
+        locks: Stamped = []
+        for dirPath, entries in listTree(pool, dirPaths, []).items():
+            for name, st in entries:
+                if not name.startswith('.') or not stat.S_ISREG(st.st_mode):
+                    continue
+                if name.endswith('.gm'):
+                    infos.append((path.join(dirPath, name), st.st_mtime))
+                elif name.endswith('.gm.lock'):
+                    locks.append((path.join(dirPath, name), st.st_mtime))
+        return infos, locks
+
+
+class InfoDatabase(InfoFiles):
+
+    """ Keeps the build info of all targets in one SQLite database.
+
+    Rows are keyed by the dotfile name the target would otherwise use.
+    While a target builds, its dependencies are journaled to a file in
+    <database>.d, which is imported into the database in one transaction
+    when the build succeeds.  Lock files live there too. """
+
+    def __init__(self, database: FullPath):
+        self.database = database
+        self._workDir = cast(FullPath, database + '.d')
+        os.makedirs(self._workDir, exist_ok=True)
+        self._local = threading.local()
+
+        with self._connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS info ('
+                'filename TEXT PRIMARY KEY, checked REAL NOT NULL, content TEXT NOT NULL)'
+            )
+
+    def _connect(self) -> 'sqlite3.Connection':
+        # Connections can't be shared between threads, or with forked children
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.database, timeout=max(theLockWait, 1))
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return cast('sqlite3.Connection', self._local.db)
+
+    def journal(self, filename: FullPath) -> FullPath:
+        return path.join(self._workDir, hashString(filename, 'md5') + '.gm')
+
+    def lockname(self, filename: FullPath) -> FullPath:
+        return cast(FullPath, self.journal(filename) + '.lock')
+
+    def read(self, filename: FullPath) -> Optional[Tuple[List[str], float]]:
+        row = self._connect().execute(
+            'SELECT content, checked FROM info WHERE filename = ?', (filename,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0].splitlines(keepends=True), row[1]
+
+    def deps(self, filename: FullPath) -> Iterator[str]:
+        info = self.read(filename)
+        return iter(info[0][1:-1] if info else [])
+
+    def ends(self, filename: FullPath) -> Optional[Tuple[str, str, float]]:
+        info = self.read(filename)
+        if info is None:
+            return None
+        lines, checked = info
+        return lines[0] if lines else '', lines[-1] if len(lines) > 1 else '', checked
+
+    def commit(self, filename: FullPath) -> None:
+        journal = self.journal(filename)
+        with self._connect() as db:
+            if path.exists(journal):
+                with open(journal, 'r') as info:
+                    lines = info.readlines()
+                # Rows in the journal are relative to its directory, not the target's
+                for i, line in enumerate(lines[1:], 1):
+                    dirPath, rest = line.split('\t', 1)
+                    lines[i] = '\t'.join([path2str(
+                        str2path(dirPath, self._workDir), path.dirname(filename)
+                    ), rest])
+                self.put(filename, ''.join(lines))
+                os.remove(journal)
+            else:
+                db.execute(
+                    'UPDATE info SET checked = ? WHERE filename = ?', (time.time(), filename)
+                )
+
+    def put(self, filename: FullPath, content: str, checked: Optional[float] = None) -> None:
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO info (filename, checked, content) VALUES (?, ?, ?)',
+                (filename, time.time() if checked is None else checked, content),
+            )
+
+    def remove(self, filename: FullPath) -> None:
+        with self._connect() as db:
+            db.execute('DELETE FROM info WHERE filename = ?', (filename,))
+        super(InfoDatabase, self).remove(self.journal(filename))
+
+    def scan(self, pool: 'ThreadPool', dirPaths: List[FullPath]) -> Tuple[Stamped, Stamped]:
+        prefixes = tuple(path.join(dirPath, '') for dirPath in dirPaths)
+        rows = self._connect().execute('SELECT filename, checked FROM info').fetchall()
+        locks = [
+            (path.join(self._workDir, name), st.st_mtime)
+            for name, st in listDirectory(self._workDir, []) if name.endswith('.gm.lock')
+        ]
+        return [row for row in rows if row[0].startswith(prefixes)], locks
+
+
+_theInfoStore: Optional[InfoFiles] = None
+_theInfoStoreLock = threading.Lock()
+
+
+def infoStore() -> InfoFiles:
+    global _theInfoStore
+    with _theInfoStoreLock:
+        if _theInfoStore is None:
+            database = os.environ.get(theDatabaseName)
+            _theInfoStore = InfoDatabase(cast(FullPath, database)) if database else InfoFiles()
+        return _theInfoStore
+
+
+class Dependencies:
+
+    """ The dependencies recorded in a target's info, read when first needed.
+
+    Aggregate targets can record tens of thousands, and most checks need
+    none of them, or stop at the first that changed.  So they're kept as
+    lines of text, and each is parsed into a BuildEvent only when used.
+    Iterating reads them from the store as it goes, and keeps them only
+    once it reaches the end. """
+
+    __slots__ = ['_store', '_filename', '_targetDir', '_lines']
+
+    def __init__(
+        self, store: Optional[InfoFiles] = None, filename: str = '', targetDir: str = ''
+    ):
+        self._store = store
+        self._filename = cast(FullPath, filename)
+        self._targetDir = cast(FullPath, targetDir)
+        self._lines: Optional[List[str]] = None if store else []
+
+    @property
+    def lines(self) -> List[str]:
+        if self._lines is None:
+            info = cast(InfoFiles, self._store).read(self._filename)
+            # Between the header and the target's own line
+            self._lines = info[0][1:-1] if info else []
+        return self._lines
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __getitem__(self, index: int) -> BuildEvent:
+        return BuildEvent.fromString(self.lines[index], self._targetDir)
+
+    def __iter__(self) -> Iterator[BuildEvent]:
+        if self._lines is not None:
+            for line in self._lines:
+                yield BuildEvent.fromString(line, self._targetDir)
+            return
+
+        # A serial check stops at the first change, so don't read past it
+        lines = []
+        for line in cast(InfoFiles, self._store).deps(self._filename):
+            lines.append(line)
+            yield BuildEvent.fromString(line, self._targetDir)
+        self._lines = lines
+
+    def critical(self, index: int) -> Seconds:
+        """ The recorded critical path of a dependency, without parsing the rest of it. """
+        args = self.lines[index].rstrip('\n').split('\t', 8)
+        return float(args[7]) if len(args) > 7 and args[7] else 0
 
 
 class Info:
@@ -245,53 +1185,99 @@ class Info:
 
     Also is a context manager to hold lock on info file. """
 
-    def __init__(self, current: BuildEvent, fakeTarget: bool = False):
+    def __init__(
+        self, current: BuildEvent, fakeTarget: bool = False, parents: Tuple[FullPath, ...] = ()
+    ):
         self.current = current
 
-        basename = '.' + path.basename(current.target)
-        if fakeTarget:
-            # This lets two different scripts use the same fake target (e.g. !default)
-            basename += '_' + hashString(current.scriptPath)
-        basename += '.gm'
-
         self.targetDir = path.dirname(current.targetPath)
-        self.filename: FullPath = str2path(basename, self.targetDir)
+        self.filename: FullPath = Info.path(current, fakeTarget)
+
+        self._store = infoStore()
+        # Dependency builds will write into self.journal
+        self.journal = self._store.journal(self.filename)
 
-        self._lockname = cast(FullPath, self.filename + '.lock')
+        self._lockname = self._store.lockname(self.filename)
+        self._lockfd: Optional[int] = None
+
+        # Info files locked by this build and its callers, innermost last
+        self.chain = parents + (self.filename,)
 
         self.timestamp: Optional[datetime] = None
+        self.format = BuildEvent.format()
         self.last: Optional[BuildEvent] = None
-        self.deps: List[BuildEvent] = []
+        self.deps = Dependencies()
+
+    @staticmethod
+    def path(command: BuildCommand, fakeTarget: bool) -> FullPath:
+        basename = '.' + path.basename(command.target)
+        if fakeTarget:
+            # This lets two different scripts use the same fake target (e.g. !default)
+            basename += '_' + hashString(command.scriptPath, 'md5')
+        basename += '.gm'
+        return str2path(basename, path.dirname(command.targetPath))
 
     @contextmanager
     def build(self) -> Generator:
         """ Context manager for dependency building. """
-        # Dependency builds will write into self.filename
-        with open(self.filename, 'w') as file:
-            file.write('\t'.join(BuildEvent.header) + '\n')
-            logger.debug('Created %s', self.filename)
+        with open(self.journal, 'w') as file:
+            file.write('\t'.join(BuildEvent.header + [BuildEvent.format()]) + '\n')
+            logger.debug('Created %s', self.journal)
 
         yield
 
+        self.current.critical = self._critical()
+
         # write final header to target
-        logger.debug('Writing %s to %s', self.current.target, self.filename)
-        with open(self.filename, 'a') as file:
-            file.write(self.current.toString(self.targetDir) + '\n')
+        logger.debug('Writing %s to %s', self.current.target, self.journal)
+        with open(self.journal, 'a') as file:
+            file.write(self.current.toString(path.dirname(self.journal)) + '\n')
+
+    def _critical(self) -> Seconds:
+        """ Seconds of the longest chain of recipes ending with this build.
+
+        Dependencies made this build usually ran inside our recipe, so their
+        time is already in its duration. """
+        timestamp = self.current.timestamp
+        before: Seconds = 0
+        during: Seconds = 0
+        with open(self.journal, 'r') as journal:
+            next(journal)
+            for line in journal:
+                args = line.rstrip('\n').split('\t')
+                if len(args) > 7 and args[7]:
+                    if args[4] == timestamp:
+                        during = max(during, float(args[7]))
+                    else:
+                        before = max(before, float(args[7]))
+        return max((self.current.duration or 0) + before, during)
 
-    def checked(self) -> None:
-        os.utime(self.filename)
+    @staticmethod
+    def load(
+        store: InfoFiles, filename: FullPath, targetDir: FullPath
+    ) -> Optional[Tuple[str, Optional[BuildEvent], float]]:
+        """ Format, the target's last event, and when the info was last checked. """
+        ends = store.ends(filename)
+        if ends is None:
+            return None
+
+        first, last, checked = ends
+        header = first.rstrip('\n').split('\t') if first else []
+        # Logs before 'gm1' had no format, and the header has grown since
+        format = (
+            header[-1] if header and header[-1] not in BuildEvent.header
+            else BuildEvent.legacyFormat
+        )
+        return format, BuildEvent.fromString(last, targetDir) if last else None, checked
 
-    def _parse(self) -> None:
-        if not path.exists(self.filename):
+    def parse(self) -> None:
+        info = Info.load(self._store, self.filename, self.targetDir)
+        if info is None:
             return
 
-        with open(self.filename, 'r') as info:
-            next(info)  # Header
-            for line in info:
-                self.deps.append(BuildEvent.fromString(line, self.targetDir))
-        self.last = self.deps[-1] if len(self.deps) > 0 else None
-        self.deps = self.deps[:-1]
-        self.timestamp = datetime.fromtimestamp(path.getmtime(self.filename))
+        self.format, self.last, checked = info
+        self.deps = Dependencies(self._store, self.filename, self.targetDir)
+        self.timestamp = datetime.fromtimestamp(checked)
         logger.debug('Read %s: %s', self.filename, self.timestamp)
 
         if self.last and self.last.scriptPath != self.current.scriptPath:
@@ -301,101 +1287,626 @@ class Info:
             )
 
     def __enter__(self) -> 'Info':
-        lockdir = path.dirname(self._lockname)
-        if lockdir:
-            os.makedirs(lockdir, exist_ok=True)
+        self._prepare()
+        self._locked(self._lock())
+        return self
 
-        retry = theLockTries
-        while True:
-            try:
-                with open(self._lockname, 'x') as lock:
-                    logger.debug('Locking %s', self._lockname)
-                    lock.write(str(self.current.timestamp) + '\n')
-                break
-            except FileExistsError:
-                if retry <= 0:
-                    raise BuildError(
-                        '%s is locked.  Possible circular dependency.' %
-                        (self._lockname)
-                    )
-                retry -= 1
+    async def __aenter__(self) -> 'Info':
+        self._prepare()
+        self._locked(await self._lockAsync())
+        return self
 
-            amount = theLockWait / (2**retry + random())
-            logger.log(
-                logging.WARN if amount > 2 else logging.DEBUG,
-                '%s is locked.  Sleep for %s', self._lockname, amount
-            )
-            Builder.sleep(amount)
+    async def __aexit__(self, *exc: Any) -> None:
+        self.__exit__(*exc)
 
-            try:
-                with open(self._lockname, 'r') as lock:
-                    lockDate = lock.readline().strip()
-                    if lockDate and str(self.current.timestamp) != lockDate:
-                        logger.debug('current.timestamp: %s', self.current.timestamp)
-                        raise BuildError(
-                            '%s is locked by %s.  Try deleting it.' %
-                            (self._lockname, lockDate)
-                        )
-            except FileNotFoundError:
-                pass  # Lock has been removed
+    def _prepare(self) -> None:
+        # Recipes rely on the target's directory existing
+        for dirPath in set([self.targetDir, path.dirname(self._lockname)]):
+            if dirPath:
+                os.makedirs(dirPath, exist_ok=True)
+
+        self.checkCycle()
+
+    def _locked(self, fd: int) -> None:
+        """ Record the holder of the lock on fd, and read the info. """
+        self._lockfd = fd
+        logger.debug('Locking %s', self._lockname)
+        os.ftruncate(self._lockfd, 0)
+        os.write(self._lockfd, ('%s\t%d\t%s\n' % (
+            self.current.timestamp, os.getpid(), self.current.target
+        )).encode('utf-8'))
 
         try:
-            self._parse()
+            self.parse()
         except Exception as e:
             self.__exit__(*sys.exc_info())
             raise BuildError(str(e))
 
-        return self
+    def checkCycle(self) -> None:
+        if self.filename in self.chain[:-1]:
+            cycle = self.chain[self.chain.index(self.filename):]
+            raise BuildError('Circular dependency: ' + ' -> '.join(
+                path2str(f, self.targetDir) for f in cycle
+            ))
 
-    def __exit__(self, *exc: Any) -> bool:
-        if path.exists(self.filename):
+    def __exit__(self, *exc: Any) -> None:
+        with Trace.span('write-gm', self.current.targetPath, self.current.script):
             if exc[0] is not None:
-                os.remove(self.filename)
+                self._store.remove(self.filename)
             else:
-                os.utime(self.filename)
-                logger.debug(
-                    'Write %s: %s',
-                    self.filename, datetime.fromtimestamp(path.getmtime(self.filename))
-                )
+                self._store.commit(self.filename)
+                logger.debug('Write %s', self.filename)
         logger.debug('Unlocking %s', self._lockname)
+        # Remove before unlocking, so waiters know to lock the next file
         os.remove(self._lockname)
-        return False
+        os.close(cast(int, self._lockfd))
+        self._lockfd = None
 
+    def _lock(self) -> int:
+        """ Open and flock the lock file.  The kernel releases it if we crash. """
+        while True:
+            fd = os.open(self._lockname, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    self._waitLock(fd)
 
-class Script:
+                if self._isCurrent(fd):
+                    return fd
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    async def _lockAsync(self) -> int:
+        """ Like _lock, but lets other tasks run while waiting. """
+        while True:
+            fd = os.open(self._lockname, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    await self._waitLockAsync(fd)
+                # Cancelling the task may not reach us, so don't build after another failed
+                Builder.sleep(0)
+
+                if self._isCurrent(fd):
+                    return fd
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def _isCurrent(self, fd: int) -> bool:
+        # The holder may have removed the file we locked
+        locked = os.fstat(fd)
+        current = os.stat(self._lockname)
+        return (locked.st_dev, locked.st_ino) == (current.st_dev, current.st_ino)
+
+    def _waitLock(self, fd: int) -> None:
+        """ Block on the lock in a helper thread, so an error elsewhere can still wake us. """
+        holder = self._holder()
+        logger.debug('%s is locked by %s.  Waiting.', self._lockname, holder)
+
+        # The helper locks a duplicate of fd, and closes it once it has the lock
+        helperFd = os.dup(fd)
+        locked = [False]
+
+        def lock() -> None:
+            try:
+                fcntl.flock(helperFd, fcntl.LOCK_EX)
+            finally:
+                os.close(helperFd)
+                Builder.notify(lambda: locked.__setitem__(0, True))
 
-    """ Parsed build file with script stanzas by target pattern. """
+        with Trace.span('lock-wait', self.current.targetPath, self.current.script) as span, \
+                self._waiting(holder):
+            span.args['holder'] = holder
+            threading.Thread(target=lock, daemon=True).start()
 
-    def __init__(self, path: FullPath):
-        self._stanzas: List[Tuple[str, bool, str]] = []
-        self._parse(path)
+            if not Builder.wait(lambda: locked[0], theLockWait):
+                self._stillLocked(holder)
+                Builder.wait(lambda: locked[0])
 
-    def match(self, target: str) -> Recipe:
-        result: Optional[str] = None
-        always, ignore, generic = False, False, True
-        for patterns, shebang, stanza in self._stanzas:
-            for p in patterns.split():
-                bang = p.startswith('!')
-                if fnmatch.fnmatch(target, p if not bang else p[1:]):
-                    result = result + stanza if result else stanza
-                    always = always or shebang
-                    ignore = ignore or bang
-                    generic = generic and p == '*'
-                    break
-        return Recipe(self.interpreter, result if not generic else None, always, ignore)
+    async def _waitLockAsync(self, fd: int) -> None:
+        holder = self._holder()
+        logger.debug('%s is locked by %s.  Waiting.', self._lockname, holder)
 
-    def _addStanza(self, pattern: Optional[str], always: bool, stanza: str) -> None:
-        if pattern is None:
-            return
+        loop = asyncio.get_event_loop()
+        locked = loop.create_future()
+        helperFd = os.dup(fd)
 
-        self._stanzas.append((pattern, always, stanza))
+        def lock() -> None:
+            try:
+                fcntl.flock(helperFd, fcntl.LOCK_EX)
+            finally:
+                os.close(helperFd)
+                try:
+                    loop.call_soon_threadsafe(resolve, locked, True)
+                except RuntimeError:
+                    pass  # The build ended while we waited
+
+        with Trace.span('lock-wait', self.current.targetPath, self.current.script) as span, \
+                self._waiting(holder):
+            span.args['holder'] = holder
+            threading.Thread(target=lock, daemon=True).start()
 
-    _shebang = re.compile('(#|//|;|--)(\?|!)(.*)$')
+            try:
+                await asyncio.wait_for(asyncio.shield(locked), theLockWait)
+            except asyncio.TimeoutError:
+                self._stillLocked(holder)
+                await locked
+            Builder.sleep(0)
 
-    def _parse(self, path: FullPath) -> None:
+    @contextmanager
+    def _waiting(self, holder: str) -> Generator:
+        """ Record our wait for the build's other waiters, and raise if it closes a cycle.
+
+        Our callers hold the locks in our chain, and can't release them until
+        we get this one.  Another process may hold this one while waiting for
+        one of theirs, when parallel branches depend on each other. """
+        memo = Memo(os.environ.get(theTimestampName))
+        with memo.waiting(self.chain[:-1], self.filename) as cycle:
+            if cycle:
+                raise BuildError('Circular dependency: %s, waiting for %s' % (
+                    ' -> '.join(path2str(f, self.targetDir) for f in cycle), holder
+                ))
+            yield
+
+    def _stillLocked(self, holder: str) -> None:
+        # Without a memo to find cycles in, waiting forever could hang the build
+        if Memo(os.environ.get(theTimestampName)).dirPath is None:
+            raise BuildError('%s is locked by %s.  Possible circular dependency.' % (
+                self._lockname, holder
+            ))
+        logger.warning('%s is still locked by %s', self._lockname, holder)
+
+    def _holder(self) -> str:
         try:
-            with open(path) as file:
-                bang = Script._shebang.match(next(file))
+            with open(self._lockname, 'r') as lock:
+                timestamp, pid, target = lock.readline().rstrip('\n').split('\t')
+                return '%s (pid %s at %s)' % (target, pid, timestamp)
+        except (OSError, ValueError):
+            return 'another process'
+
+
+class Artifacts:
+
+    """ Shared cache of built targets, in GM_ARTIFACTS.
+
+    A manifest for each recipe and script-relative target lists the
+    dependencies of earlier builds, with their checksums.  When a target
+    needs making and all of an earlier build's dependencies still match,
+    the target is copied from the cache instead of running the recipe.
+    Targets are stored by checksum, and evicted least recently used. """
+
+    def __init__(self, dirPath: FullPath):
+        self.dirPath = dirPath
+        self.limit = int(theArtifactsSize * (1 << 20))
+        self.link = env2bool(theArtifactsLinkName)
+
+    @staticmethod
+    def fromEnv() -> Optional['Artifacts']:
+        dirPath = os.environ.get(theArtifactsName)
+        return Artifacts(cast(FullPath, dirPath)) if dirPath else None
+
+    @staticmethod
+    def cacheable(recipe: Recipe) -> bool:
+        # Shebang and "!" recipes are run for their side effects
+        return bool(recipe.script) and not recipe.always and not recipe.ignore
+
+    def restore(
+        self, info: Info, timestamp: datetime, changed: Callable[[BuildEvent], Optional[str]]
+    ) -> bool:
+        """ Restore info's target from an earlier build with unchanged dependencies. """
+        for entry in reversed(self._read(info.current)):
+            objectPath = self._object(entry['checksum'])
+            if not path.exists(objectPath):
+                continue
+
+            deps = [BuildEvent.fromString(line, info.targetDir) for line in entry['deps']]
+            reason = next((r for r in map(changed, deps) if r), None)
+            if reason:
+                logger.debug('Cached %s is stale because %s', info.current.target, reason)
+                continue
+
+            try:
+                with info.build():
+                    self._copy(objectPath, info.current.targetPath, self.link)
+                    os.chmod(info.current.targetPath, entry['mode'])
+                    with open(info.journal, 'a') as journal:
+                        for dep in deps:
+                            journal.write(dep.toString(path.dirname(info.journal)) + '\n')
+                    info.current.refresh(timestamp, False)
+            except OSError as e:
+                logger.debug('Not restoring %s: %s', info.current.target, e)
+                continue
+
+            if info.current.checksum != entry['checksum']:
+                logger.warning('Removing corrupt cached %s', objectPath)
+                os.remove(objectPath)
+                continue
+
+            os.utime(objectPath)
+            logger.info('Restored %s from %s', info.current.target, self.dirPath)
+            self._count('hit')
+            return True
+
+        self._count('miss')
+        return False
+
+    def store(self, info: Info) -> None:
+        """ Add info's freshly built target to the cache. """
+        checksum = info.current.checksum
+        if checksum is None or checksum in BuildEvent.nonsums + ['missing']:
+            return
+        if not stat.S_ISREG(os.stat(info.current.targetPath).st_mode):
+            return
+
+        with open(info.journal, 'r') as journal:
+            lines = journal.readlines()[1:-1]
+        entry = {
+            'deps': [
+                BuildEvent.fromString(line, path.dirname(info.journal)).toString(info.targetDir)
+                for line in lines
+            ],
+            'checksum': checksum,
+            'mode': stat.S_IMODE(os.stat(info.current.targetPath).st_mode),
+        }
+
+        try:
+            objectPath = self._object(checksum)
+            if path.exists(objectPath):
+                os.utime(objectPath)
+            else:
+                os.makedirs(path.dirname(objectPath), exist_ok=True)
+                # Never link the target into the cache, because recipes may change it in place
+                self._copy(info.current.targetPath, objectPath, False)
+
+            entries = [e for e in self._read(info.current) if e != entry] + [entry]
+            manifestPath = self._manifest(info.current)
+            os.makedirs(path.dirname(manifestPath), exist_ok=True)
+            self._write(manifestPath, ''.join(
+                json.dumps(e) + '\n' for e in entries[-theArtifactEntries:]
+            ).encode('utf-8'))
+        except OSError as e:
+            logger.warning('Not caching %s: %s', info.current.target, e)
+            return
+
+        logger.debug('Cached %s as %s', info.current.target, objectPath)
+        self._count('store')
+
+    def evict(self) -> None:
+        """ Remove the least recently used targets beyond GM_ARTIFACTS_SIZE. """
+        objects = []
+        total = 0
+        for root, dirs, files in os.walk(path.join(self.dirPath, 'objects')):
+            for name in files:
+                objectPath = path.join(cast(FullPath, root), name)
+                try:
+                    st = os.stat(objectPath)
+                except OSError:
+                    continue
+                objects.append((st.st_mtime, st.st_size, objectPath))
+                total += st.st_size
+
+        evicted = 0
+        for mtime, size, objectPath in sorted(objects):
+            if total <= self.limit:
+                break
+            try:
+                os.remove(objectPath)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        if evicted:
+            logger.info('Evicted %d targets from %s', evicted, self.dirPath)
+            self._count('evict', evicted)
+            self._prune()
+
+    def _prune(self) -> None:
+        """ Drop manifest entries whose targets were evicted, and empty manifests. """
+        for root, dirs, files in os.walk(path.join(self.dirPath, 'manifests')):
+            for name in files:
+                if '.' in name:
+                    continue  # Still being written by store
+                manifestPath = path.join(cast(FullPath, root), name)
+                try:
+                    with open(manifestPath, 'r') as manifest:
+                        lines = manifest.readlines()
+                    kept = [
+                        line for line in lines
+                        if path.exists(self._object(json.loads(line)['checksum']))
+                    ]
+                    if not kept:
+                        os.remove(manifestPath)
+                    elif len(kept) < len(lines):
+                        self._write(manifestPath, ''.join(kept).encode('utf-8'))
+                except (OSError, ValueError, KeyError) as e:
+                    logger.debug('Not pruning %s: %s', manifestPath, e)
+
+    def stats(self) -> Dict[str, int]:
+        counts = {'objects': 0, 'bytes': 0, 'manifests': 0, 'limit': self.limit}
+        for kind in ['objects', 'manifests']:
+            for root, dirs, files in os.walk(path.join(self.dirPath, kind)):
+                for name in files:
+                    counts[kind] += 1
+                    if kind == 'objects':
+                        counts['bytes'] += path.getsize(path.join(cast(FullPath, root), name))
+
+        try:
+            with open(path.join(self.dirPath, 'events'), 'r') as events:
+                for line in events:
+                    kind, count = line.split()
+                    counts[kind] = counts.get(kind, 0) + int(count)
+        except FileNotFoundError:
+            pass
+
+        return counts
+
+    def _manifest(self, current: BuildEvent) -> FullPath:
+        # Relative to the script, so other checkouts share the cache
+        target = path.relpath(
+            path.realpath(current.targetPath), path.dirname(path.realpath(current.scriptPath))
+        )
+        key = hashString('\t'.join([BuildEvent.format(), current.stanza, target]), 'md5')
+        return path.join(self.dirPath, 'manifests', key[:2], key)
+
+    def _object(self, checksum: Hash) -> FullPath:
+        return path.join(self.dirPath, 'objects', theHash, checksum[:2], checksum)
+
+    def _read(self, current: BuildEvent) -> List[Dict[str, Any]]:
+        try:
+            with open(self._manifest(current), 'r') as manifest:
+                return [json.loads(line) for line in manifest]
+        except FileNotFoundError:
+            return []
+        except ValueError as e:
+            logger.debug('Ignoring manifest of %s: %s', current.target, e)
+            return []
+
+    def _count(self, kind: str, count: int = 1) -> None:
+        try:
+            os.makedirs(self.dirPath, exist_ok=True)
+            fd = os.open(
+                path.join(self.dirPath, 'events'), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666
+            )
+            try:
+                os.write(fd, ('%s %d\n' % (kind, count)).encode('utf-8'))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.debug('Not counting %s: %s', kind, e)
+
+    @staticmethod
+    def _write(fullPath: FullPath, data: bytes) -> None:
+        temp = cast(FullPath, '%s.%d.%d' % (fullPath, os.getpid(), threading.get_ident()))
+        with open(temp, 'wb') as file:
+            file.write(data)
+        os.replace(temp, fullPath)
+
+    @staticmethod
+    def _copy(source: FullPath, dest: FullPath, link: bool) -> None:
+        """ Atomically hardlink, reflink, or copy source to dest. """
+        temp = cast(FullPath, '%s.%d.%d' % (dest, os.getpid(), threading.get_ident()))
+        try:
+            if link:
+                os.link(source, temp)
+            else:
+                with open(source, 'rb') as src, open(temp, 'wb') as dst:
+                    try:
+                        fcntl.ioctl(dst.fileno(), theFICLONE, src.fileno())
+                    except OSError:
+                        shutil.copyfileobj(src, dst, theReadSize)
+            os.replace(temp, dest)
+        except OSError:
+            if path.exists(temp):
+                os.remove(temp)
+            raise
+
+
+class Script:
+
+    """ Parsed build file with script stanzas by target pattern. """
+
+    # Changes when the parsed form does, so older cached scripts are ignored
+    revision = 3
+
+    def __init__(self, path: FullPath):
+        self._stanzas: List[Tuple[str, bool, str]] = []
+        # Bytes of memory declared by stanzas, and stanzas run for many targets at once
+        self._memory: Dict[int, int] = {}
+        self._batch: Set[int] = set()
+        self._group: Set[int] = set()
+        self._parse(path)
+        self._compile()
+
+    @staticmethod
+    def load(scriptPath: FullPath) -> 'Script':
+        """ Get a parsed script from the cache in GM_CACHE, or parse and cache it. """
+        try:
+            st = os.stat(scriptPath)
+        except OSError as e:
+            raise BuildError(str(e))
+
+        if not env2bool(theScriptCacheName, True):
+            with Trace.span('parse', '', scriptPath):
+                return Script(scriptPath)
+
+        key = hashString(' '.join([
+            theVersion, str(Script.revision), scriptPath, StatCache.fingerprint(st)
+        ]), 'md5')
+        cachePath = path.join(theCacheDir, 'scripts', key[:2], key + '.pickle')
+
+        try:
+            with open(cachePath, 'rb') as cached:
+                logger.debug('Loading %s from %s', scriptPath, cachePath)
+                return cast(Script, pickle.load(cached))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.debug('Ignoring %s: %s', cachePath, e)
+
+        with Trace.span('parse', '', scriptPath):
+            script = Script(scriptPath)
+
+        if not StatCache.racy(st):
+            try:
+                os.makedirs(path.dirname(cachePath), exist_ok=True)
+                temp = cast(FullPath, '%s.%d.%d' % (cachePath, os.getpid(), threading.get_ident()))
+                with open(temp, 'wb') as cached:
+                    pickle.dump(script, cached, pickle.HIGHEST_PROTOCOL)
+                os.replace(temp, cachePath)
+            except OSError as e:
+                logger.debug('Not caching %s: %s', scriptPath, e)
+
+        return script
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        del state['_cachedMatch']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._cachedMatch = lru_cache(maxsize=theMatchCache)(self._match)
+
+    def match(self, target: str) -> Recipe:
+        return self._cachedMatch(target)
+
+    def _match(self, target: str) -> Recipe:
+        # The first matching pattern of each stanza, by stanza
+        matches: Dict[int, Tuple[int, bool, str]] = {}
+
+        def add(found: Optional[List[StanzaPattern]]) -> None:
+            for i, position, bang, p in found or []:
+                if i not in matches or position < matches[i][0]:
+                    matches[i] = (position, bang, p)
+
+        add(self._literals.get(target))
+        for length in self._prefixLengths:
+            if length <= len(target):
+                add(self._prefixes.get(target[:length]))
+        for length in self._suffixLengths:
+            if length <= len(target):
+                add(self._suffixes.get(target[len(target) - length:]))
+        if self._globs:
+            found = cast(Match[str], self._globs.match(target)).groupdict()
+            add([
+                self._globList[int(k[2:])] for k, v in found.items()
+                if k[:2] == '_p' and v is not None
+            ])
+
+        result: Optional[str] = None
+        always, ignore, generic = False, False, True
+        memory, batch = 0, False
+        outputs: List[str] = []
+        for i in sorted(matches):
+            _, bang, p = matches[i]
+            patterns, shebang, stanza = self._stanzas[i]
+            result = result + stanza if result else stanza
+            always = always or shebang
+            ignore = ignore or bang
+            generic = generic and p == '*'
+            memory = max(memory, self._memory.get(i, 0))
+            batch = batch or i in self._batch
+            if i in self._group and not outputs:
+                outputs = Script._outputs(patterns, p, target)
+        return Recipe(
+            self.interpreter, result if not generic else None, always, ignore, memory, batch,
+            outputs,
+        )
+
+    @staticmethod
+    def _outputs(patterns: str, pattern: str, target: str) -> List[str]:
+        """ Every target of a group stanza, with the stem that target matched for "*". """
+        glob = pattern.lstrip('!')
+        if '*' not in glob:
+            return [p.lstrip('!') for p in patterns.split()]
+        prefix, suffix = glob.split('*')
+        stem = target[len(prefix):len(target) - len(suffix)]
+        return [p.lstrip('!').replace('*', stem) for p in patterns.split()]
+
+    def _compile(self) -> None:
+        """ Index patterns as literals, "prefix*", "*suffix", or one combined regex. """
+        self._literals: Dict[str, List[StanzaPattern]] = {}
+        self._prefixes: Dict[str, List[StanzaPattern]] = {}
+        self._suffixes: Dict[str, List[StanzaPattern]] = {}
+        self._globList: List[StanzaPattern] = []
+        globs: List[str] = []
+
+        magic = re.compile('[*?[]')
+        for i, (patterns, _, _) in enumerate(self._stanzas):
+            for position, p in enumerate(patterns.split()):
+                bang = p.startswith('!')
+                glob = p[1:] if bang else p
+                entry = (i, position, bang, p)
+
+                star = glob.find('*')
+                if not magic.search(glob):
+                    self._literals.setdefault(glob, []).append(entry)
+                elif star == len(glob) - 1 and not magic.search(glob[:-1]):
+                    self._prefixes.setdefault(glob[:-1], []).append(entry)
+                elif star == 0 and not magic.search(glob[1:]):
+                    self._suffixes.setdefault(glob[1:], []).append(entry)
+                else:
+                    # Each optional lookahead records whether one pattern matched
+                    globs.append('(?:(?=(?P<_p%d>%s))|)' % (
+                        len(self._globList), fnmatch.translate(glob)
+                    ))
+                    self._globList.append(entry)
+
+        self._prefixLengths = sorted(set(len(p) for p in self._prefixes))
+        self._suffixLengths = sorted(set(len(s) for s in self._suffixes))
+        self._globs = re.compile(''.join(globs)) if globs else None
+        self._cachedMatch = lru_cache(maxsize=theMatchCache)(self._match)
+
+    _resource = re.compile(r'\+(\w+)(?:=(\d+)([KMGT]?))?$', re.IGNORECASE)
+
+    def _addStanza(self, pattern: Optional[str], always: bool, stanza: str) -> None:
+        if pattern is None:
+            return
+
+        # Resources and options are declared like "+mem=4G" or "+batch" among the patterns
+        i = len(self._stanzas)
+        patterns = []
+        for word in pattern.split():
+            resource = Script._resource.match(word)
+            if not resource:
+                patterns.append(word)
+            elif resource.group(1) == 'mem' and resource.group(2):
+                size = int(resource.group(2)) * theSizeSuffixes[resource.group(3).upper()]
+                self._memory[i] = size
+            elif word == '+batch':
+                self._batch.add(i)
+            elif word == '+group':
+                self._group.add(i)
+            else:
+                raise BuildError('Unknown resource %s for %s' % (word, pattern.strip()))
+
+        if i in self._group and i in self._batch:
+            raise BuildError('Stanzas can\'t be both +batch and +group: ' + pattern.strip())
+        if i in self._group:
+            stars = set(p.count('*') for p in patterns)
+            if len(stars) > 1 or stars - {0, 1} or any(re.search('[?[]', p) for p in patterns):
+                message = 'Patterns for +group must all be literal, or all have one "*": '
+                raise BuildError(message + pattern.strip())
+
+        self._stanzas.append((' '.join(patterns), always, stanza))
+
+    _shebang = re.compile('(#|//|;|--)(\?|!)(.*)$')
+
+    def _parse(self, path: FullPath) -> None:
+        try:
+            with open(path) as file:
+                bang = Script._shebang.match(next(file))
                 if not bang:
                     raise BuildError('Missing first line "#!" in %s' % (path))
 
@@ -429,9 +1940,462 @@ class Script:
             raise BuildError(str(e))
 
 
+class JobServer:
+
+    """ Build-wide limit on concurrently running recipes.
+
+    Like GNU make's jobserver, the top-level goodmake creates a fifo holding
+    GM_THREADS - 1 tokens, and passes its path to nested invocations in
+    GM_JOBSERVER.  Each goodmake process has one implicit token, lent by the
+    recipe that ran it, so a recipe waiting on its children never holds a
+    token they need.  Additional concurrent recipes in a process each take a
+    token from the fifo while they run. """
+
+    def __init__(self, fifoPath: Optional[FullPath]):
+        self.fifoPath = fifoPath
+        self._fd: Optional[int] = None
+        self._lock = threading.Lock()
+        self._asyncLock: Optional['asyncio.Lock'] = None
+        self._implicit = True
+
+        # Wakes threads waiting on the fifo when the implicit token is released
+        self._wakeRead, self._wakeWrite = os.pipe()
+        os.set_blocking(self._wakeRead, False)
+
+        if fifoPath:
+            try:
+                self._fd = os.open(fifoPath, os.O_RDWR | os.O_NONBLOCK)
+            except OSError as e:
+                logger.debug('No jobserver at %s: %s', fifoPath, e)
+
+    @staticmethod
+    def create(timestamp: str, tokens: int = theMaxThreads) -> 'JobServer':
+        """ Create a new jobserver for a top-level build, with tokens for that many recipes. """
+        key = hashString('%s %s' % (os.getpid(), timestamp), 'md5')
+        fifoPath = path.join(cast(FullPath, tempfile.gettempdir()), 'goodmake-%s.jobs' % key)
+        os.mkfifo(fifoPath, 0o600)
+
+        jobs = JobServer(fifoPath)
+        if jobs._fd is not None and tokens > 1:
+            os.write(jobs._fd, b'+' * (tokens - 1))
+        return jobs
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        os.close(self._wakeRead)
+        os.close(self._wakeWrite)
+
+    def remove(self) -> None:
+        self.close()
+        if self.fifoPath:
+            os.remove(self.fifoPath)
+
+    def acquire(self) -> bool:
+        """ Wait for a token.  Returns whether it came from the fifo. """
+        while True:
+            with self._lock:
+                if self._implicit:
+                    self._implicit = False
+                    return False
+
+            if self._fd is None:
+                return False
+
+            readable, _, _ = select.select([self._fd, self._wakeRead], [], [], .1)
+            Builder.sleep(0)
+            try:
+                if self._wakeRead in readable:
+                    os.read(self._wakeRead, 64)
+                if self._fd in readable and os.read(self._fd, 1):
+                    return True
+            except BlockingIOError:
+                pass  # Another process or thread took it
+
+    async def acquireAsync(self) -> bool:
+        """ Like acquire, without blocking the event loop. """
+        loop = asyncio.get_event_loop()
+        while True:
+            with self._lock:
+                if self._implicit:
+                    self._implicit = False
+                    return False
+
+            if self._fd is None:
+                return False
+
+            # A descriptor has one reader callback, so tasks take turns watching the fifo
+            if self._asyncLock is None:
+                self._asyncLock = asyncio.Lock()
+            async with self._asyncLock:
+                readable = loop.create_future()
+                for fd in [self._fd, self._wakeRead]:
+                    loop.add_reader(fd, resolve, readable, None)
+                try:
+                    # Threads of batch builds may take the wakeup, so look again now and then
+                    await asyncio.wait([readable], timeout=.1)
+                finally:
+                    for fd in [self._fd, self._wakeRead]:
+                        loop.remove_reader(fd)
+
+                Builder.sleep(0)
+                try:
+                    os.read(self._wakeRead, 64)
+                except BlockingIOError:
+                    pass
+                try:
+                    if os.read(self._fd, 1):
+                        return True
+                except BlockingIOError:
+                    pass  # Another process or thread took it
+
+    def release(self, fromFifo: bool) -> None:
+        if not fromFifo:
+            with self._lock:
+                self._implicit = True
+            os.write(self._wakeWrite, b'+')
+        elif self._fd is not None:
+            os.write(self._fd, b'+')
+
+
+class Memo:
+
+    """ Results of targets already checked or made this build, shared by its processes.
+
+    Once a target's build info is saved, its BuildEvent is written to a
+    file named from its info file, in a directory for GM_STARTTIME in
+    /dev/shm.  Later requests for it read that, instead of locking and
+    parsing its build info.  Checksums of files without recipes are kept
+    with their stat fingerprints, unless they changed too recently. """
+
+    def __init__(self, timestamp: Optional[str]):
+        self.dirPath = Memo.path(timestamp) if timestamp else None
+        # Nested builds use the memo only if the top-level build made one
+        if self.dirPath and not path.isdir(self.dirPath):
+            self.dirPath = None
+
+    @staticmethod
+    def path(timestamp: str) -> FullPath:
+        key = hashString('%s %s' % (os.getuid(), timestamp), 'md5')
+        shmDir = cast(FullPath, '/dev/shm')
+        tempDir = shmDir if path.isdir(shmDir) else cast(FullPath, tempfile.gettempdir())
+        return path.join(tempDir, 'goodmake-%s.memo' % key)
+
+    @staticmethod
+    def create(timestamp: str) -> 'Memo':
+        """ Create the memo for a top-level build. """
+        os.makedirs(Memo.path(timestamp), exist_ok=True)
+        return Memo(timestamp)
+
+    def remove(self) -> None:
+        if self.dirPath:
+            shutil.rmtree(self.dirPath, ignore_errors=True)
+
+    def get(self, info: Info) -> Optional[BuildEvent]:
+        line = self._read(info.filename)
+        if line is None:
+            return None
+        event = BuildEvent.fromString(line, info.targetDir)
+        # A conflicting script gets the error from Info.parse
+        return event if event.scriptPath == info.current.scriptPath else None
+
+    def lookup(self, command: BuildCommand) -> Optional[BuildEvent]:
+        """ Like get, without the recipe that tells whether command is a fake target.
+
+        The result is only trusted if just one of its two info files was checked. """
+        found = []
+        for fakeTarget in [False, True]:
+            line = self._read(Info.path(command, fakeTarget))
+            if line is not None:
+                found.append(BuildEvent.fromString(line, path.dirname(command.targetPath)))
+        if len(found) != 1 or found[0].scriptPath != command.scriptPath:
+            return None
+        return found[0]
+
+    def put(self, info: Info, event: BuildEvent) -> None:
+        self._write(info.filename, event.toString(info.targetDir))
+
+    @contextmanager
+    def waiting(self, held: Tuple[FullPath, ...], wanted: FullPath) -> Generator:
+        """ Record that the holders of held wait for wanted.
+
+        Yields the cycle of info files that makes this a deadlock, starting
+        and ending with one of held, or None. """
+        if self.dirPath is None:
+            yield None
+            return
+
+        waitsDir = path.join(self.dirPath, 'waits')
+        line = '\t'.join((wanted,) + held)
+        record = path.join(waitsDir, '%d.%d.%s' % (
+            os.getpid(), threading.get_ident(), hashString(line, 'md5')
+        ))
+        temp = cast(FullPath, record + '.tmp')
+        os.makedirs(waitsDir, exist_ok=True)
+        with open(temp, 'w') as file:
+            file.write(line + '\n')
+        os.replace(temp, record)
+        try:
+            # Whichever waiter closes a cycle finds it, since the others already recorded theirs
+            yield Memo._cycle(Memo._waits(waitsDir), held, wanted)
+        finally:
+            os.remove(record)
+
+    @staticmethod
+    def _waits(waitsDir: FullPath) -> Dict[FullPath, Set[FullPath]]:
+        """ The info files each locked info file's holder waits for. """
+        waits: Dict[FullPath, Set[FullPath]] = {}
+        for name in os.listdir(waitsDir):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                with open(path.join(waitsDir, name), 'r') as file:
+                    wanted, *held = file.read().rstrip('\n').split('\t')
+            except (FileNotFoundError, ValueError):
+                continue
+            for lock in held:
+                waits.setdefault(cast(FullPath, lock), set()).add(cast(FullPath, wanted))
+        return waits
+
+    @staticmethod
+    def _cycle(
+        waits: Dict[FullPath, Set[FullPath]], held: Tuple[FullPath, ...], wanted: FullPath
+    ) -> Optional[List[FullPath]]:
+        # Breadth first from wanted, to a lock we hold
+        previous: Dict[FullPath, Optional[FullPath]] = {wanted: None}
+        pending = [wanted]
+        while pending:
+            lock = pending.pop(0)
+            if lock in held:
+                cycle: List[FullPath] = []
+                step: Optional[FullPath] = lock
+                while step is not None:
+                    cycle.insert(0, step)
+                    step = previous[step]
+                return [lock] + cycle
+            for waited in waits.get(lock, ()):
+                if waited not in previous:
+                    previous[waited] = lock
+                    pending.append(waited)
+        return None
+
+    def hashSource(self, targetPath: FullPath) -> Hash:
+        """ The checksum of a file without a recipe. """
+        try:
+            st = os.stat(targetPath)
+        except OSError:
+            return BuildEvent._hashFile(targetPath)
+
+        # Files inside a directory can change without changing its stat
+        if stat.S_ISDIR(st.st_mode):
+            return BuildEvent._hashFile(targetPath)
+
+        fingerprint = StatCache.fingerprint(st)
+        line = self._read(targetPath)
+        if line is not None and line.startswith(fingerprint + '\t'):
+            return line.split('\t')[1]
+
+        checksum = BuildEvent._hashFile(targetPath)
+        if not StatCache.racy(st):
+            self._write(targetPath, fingerprint + '\t' + checksum)
+        return checksum
+
+    def _entry(self, key: str) -> FullPath:
+        return path.join(cast(FullPath, self.dirPath), hashString(key, 'md5'))
+
+    def _read(self, key: str) -> Optional[str]:
+        if self.dirPath is None:
+            return None
+        try:
+            with open(self._entry(key), 'r') as entry:
+                return entry.read().rstrip('\n')
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, line: str) -> None:
+        if self.dirPath is None:
+            return
+        entry = self._entry(key)
+        temp = cast(FullPath, '%s.%d.%d' % (entry, os.getpid(), threading.get_ident()))
+        try:
+            with open(temp, 'w') as file:
+                file.write(line + '\n')
+            os.replace(temp, entry)
+        except OSError as e:
+            logger.debug('Not remembering %s: %s', key, e)
+
+
+class Admission:
+
+    """ Delays starting recipes while the machine is busy, like make -l.
+
+    A recipe waits while the 1-minute load average is above GM_MAX_LOAD,
+    while PSI cpu or memory pressure is above GM_MAX_PRESSURE percent, or
+    while its declared memory wouldn't fit beside the recipes already
+    running.  Running recipes are listed in a per-build directory, so the
+    limits hold across nested invocations.  A recipe always starts if no
+    other recipe is running, except the ones waiting on it, or if it has
+    waited longer than GM_TIMEOUT. """
+
+    def __init__(self, timestamp: str):
+        self.maxLoad = float(os.environ.get(theMaxLoadName) or 0)
+        self.maxPressure = float(os.environ.get(theMaxPressureName) or 0)
+        self.dirPath = Admission.path(timestamp)
+
+    @staticmethod
+    def path(timestamp: str) -> FullPath:
+        key = hashString('%s %s' % (os.getuid(), timestamp), 'md5')
+        return path.join(cast(FullPath, tempfile.gettempdir()), 'goodmake-%s.running' % key)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.dirPath, ignore_errors=True)
+
+    @contextmanager
+    def admit(self, info: Info, recipe: Recipe) -> Generator:
+        """ Wait until recipe can start, and list it as running until the context exits. """
+        if not (self.maxLoad or self.maxPressure or recipe.memory):
+            yield
+            return
+
+        with Trace.span('admit', info.current.targetPath, info.current.script) as span:
+            for _ in self._waiting(info, recipe, span):
+                Builder.wait(lambda: False, theAdmitInterval)
+
+        try:
+            yield
+        finally:
+            self.leave(info)
+
+    async def admitAsync(self, info: Info, recipe: Recipe) -> bool:
+        """ Like admit, without blocking the event loop.  Returns whether to leave(info) after. """
+        if not (self.maxLoad or self.maxPressure or recipe.memory):
+            return False
+
+        with Trace.span('admit', info.current.targetPath, info.current.script) as span:
+            for _ in self._waiting(info, recipe, span):
+                await asyncio.sleep(theAdmitInterval)
+        return True
+
+    def leave(self, info: Info) -> None:
+        with self._locked():
+            os.remove(self._entry(info))
+
+    def _entry(self, info: Info) -> FullPath:
+        return path.join(self.dirPath, hashString(info.filename, 'md5'))
+
+    def _waiting(self, info: Info, recipe: Recipe, span: Span) -> Generator:
+        """ Yields each time recipe must wait, until it is listed as running. """
+        ancestors = set(hashString(f, 'md5') for f in info.chain[:-1])
+        deadline = time.time() + theLockWait
+
+        waited = False
+        while True:
+            with self._locked():
+                reason = self._busy(recipe, ancestors)
+                if reason is None or time.time() > deadline:
+                    with open(self._entry(info), 'w') as running:
+                        running.write('%d\t%d\n' % (os.getpid(), recipe.memory))
+                    break
+
+            if not waited:
+                logger.info('Waiting to start %s because %s', info.current.target, reason)
+                waited = True
+            yield
+
+        if reason is not None:
+            logger.warning('Starting %s, though %s', info.current.target, reason)
+        span.args['reason'] = reason
+
+    @contextmanager
+    def _locked(self) -> Generator:
+        os.makedirs(self.dirPath, exist_ok=True)
+        fd = os.open(path.join(self.dirPath, '.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _busy(self, recipe: Recipe, ancestors: Set[str]) -> Optional[str]:
+        """ Returns why recipe shouldn't start yet, or None. """
+        reserved = 0
+        others = 0
+        for name in os.listdir(self.dirPath):
+            if name.startswith('.') or name in ancestors:
+                continue
+            try:
+                with open(path.join(self.dirPath, name), 'r') as running:
+                    pid, memory = running.read().split()
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                logger.debug('Removing stale %s', name)
+                os.remove(path.join(self.dirPath, name))
+                continue
+            except PermissionError:
+                pass  # Still running, as another user
+            except (OSError, ValueError) as e:
+                logger.debug('Ignoring %s: %s', name, e)
+                continue
+            reserved += int(memory)
+            others += 1
+
+        if not others:
+            return None
+
+        if self.maxLoad:
+            load = os.getloadavg()[0]
+            if load > self.maxLoad:
+                return 'the load is %.2f' % load
+
+        if self.maxPressure:
+            for kind in ['cpu', 'memory']:
+                pressure = Admission._pressure(kind)
+                if pressure is not None and pressure > self.maxPressure:
+                    return '%s pressure is %.1f%%' % (kind, pressure)
+
+        if recipe.memory:
+            available = Admission._available()
+            if available is not None and reserved + recipe.memory > available:
+                return '%d MiB is available, and %d MiB is used by running recipes' % (
+                    available >> 20, reserved >> 20
+                )
+
+        return None
+
+    @staticmethod
+    def _pressure(kind: str) -> Optional[float]:
+        """ Percent of the last 10 seconds that some tasks stalled, on Linux. """
+        try:
+            with open('/proc/pressure/' + kind, 'r') as pressure:
+                for line in pressure:
+                    if line.startswith('some '):
+                        return float(line.split()[1].split('=')[1])
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    @staticmethod
+    def _available() -> Optional[int]:
+        """ Bytes of memory available without swapping, on Linux. """
+        try:
+            with open('/proc/meminfo', 'r') as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) << 10
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+
 class Builder:
     error: Optional[Exception] = None
 
+    # Notified when error is set, or when Builder.notify changes other state
+    _changed = threading.Condition()
+    # Recipe processes, from subprocess or asyncio, and connections to workers running recipes
+    _running: Set[Any] = set()
+
     @staticmethod
     def sleep(amount: Seconds) -> None:
         if Builder.error is None and amount > 0:
@@ -440,18 +2404,100 @@ class Builder:
             logger.debug('%s: Another thread errored %s', os.getpid(), Builder.error)
             raise Builder.error
 
-    def __init__(self) -> None:
+    @staticmethod
+    def fail(error: Exception) -> None:
+        """ Stop the build: wake waiting threads and kill running recipes. """
+        with Builder._changed:
+            Builder.error = error
+            for process in Builder._running:
+                Builder._kill(process)
+            Builder._changed.notify_all()
+
+    @staticmethod
+    def wait(ready: Callable[[], bool], timeout: Optional[Seconds] = None) -> bool:
+        """ Wait until ready(), or raise another thread's error.  Returns False on timeout. """
+        with Builder._changed:
+            isReady = Builder._changed.wait_for(
+                lambda: ready() or Builder.error is not None, timeout
+            )
+        Builder.sleep(0)
+        return isReady
+
+    @staticmethod
+    def notify(change: Callable[[], None]) -> None:
+        with Builder._changed:
+            change()
+            Builder._changed.notify_all()
+
+    @staticmethod
+    def started(process: Any) -> None:
+        with Builder._changed:
+            Builder._running.add(process)
+            if Builder.error:
+                Builder._kill(process)
+
+    @staticmethod
+    def _kill(process: Any) -> None:
+        if isinstance(process, subprocess.Popen):
+            process.kill()
+        elif isinstance(process, socket.socket):
+            # The worker kills the recipe when we hang up
+            try:
+                process.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        elif process.returncode is None:
+            # asyncio's kill polls, which would reap the child from under its watcher
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    @staticmethod
+    def finished(process: Any) -> None:
+        with Builder._changed:
+            Builder._running.discard(process)
+
+    def __init__(self, scripts: Optional[Dict[FullPath, 'Script']] = None) -> None:
         self.timestamp = str2date(os.environ.get(theTimestampName, 'now'))
         logger.debug('Build: %s', self.timestamp)
 
-        self._remake = os.environ.get(theRemakeName, 'false').lower() in ['true', 'yes', '1', 'on']
+        self._remake = env2bool(theRemakeName)
 
-        self._scripts: Dict[FullPath, Script] = {}
+        self._scripts: Dict[FullPath, Script] = dict(scripts or {})
         self._scriptLock = threading.Lock()
 
-    def build(self, command: BuildCommand) -> BuildEvent:
+        self._chain = tuple(
+            cast(FullPath, p) for p in os.environ.get(theChainName, '').split(os.pathsep) if p
+        )
+
+        self._jobs = JobServer(cast(Optional[FullPath], os.environ.get(theJobServerName)))
+        self._workers = WorkerPool.fromEnv()
+
+        self._parallelCheck = env2bool(theParallelCheckName)
+        self._checkPool: Optional['ThreadPool'] = None
+        self._checkSlots = threading.Semaphore(theMaxThreads)
+
+        self._artifacts = Artifacts.fromEnv()
+
+        self._admission = Admission(date2str(self.timestamp))
+
+        self._memo = Memo(os.environ.get(theTimestampName))
+
+    def close(self) -> None:
+        """ Release what this builder holds open, when builders come and go in one process. """
+        self._jobs.close()
+        if self._checkPool is not None:
+            self._checkPool.shutdown()
+            self._checkPool = None
+
+    def build(
+        self, command: BuildCommand, parents: Optional[Tuple[FullPath, ...]] = None
+    ) -> BuildEvent:
         """ Build <target> with <script> from current directory if it needs updating.
 
+        parents are the info files locked by the targets that depend on this one.
+
         Returns BuildEvent for target.
         """
         recipe = self._getRecipe(command)
@@ -459,18 +2505,54 @@ class Builder:
 
         logger.debug('Checking %s', current)
 
+        if recipe.outputs and recipe.script is not None:
+            # All the targets of a group are made together
+            commands = [BuildCommand(command.dirPath, command.script, t) for t in recipe.outputs]
+            targets = [c.targetPath for c in commands]
+            return self.buildBatch(commands, parents)[targets.index(command.targetPath)]
+
+        if recipe.batch and recipe.script is not None:
+            return self.buildBatch([command], parents)[0]
+
         if current.stanza == 'missing' and path.exists(command.targetPath):
             logger.info('Dependency %s', command.target)
-            current.refresh(None, False)
+            current.timestamp = date2str(None)
+            current.checksum = self._memo.hashSource(command.targetPath)
             return current
 
         current.timestamp = date2str(self.timestamp)
+        parents = self._chain if parents is None else parents
+        info = Info(current, recipe.ignore, parents)
+
+        memoized = self._memo.get(info)
+        if memoized is not None:
+            logger.info(
+                'Skip %s from %s because it was checked this build',
+                command.target, current.script,
+            )
+            return memoized
 
-        with Info(current, recipe.ignore) as info:
-            isOK, reason = self._check(info, recipe)
+        event = self._make(command, recipe, info)
+        self._memo.put(info, event)
+        return event
+
+    def _make(self, command: BuildCommand, recipe: Recipe, info: Info) -> BuildEvent:
+        """ Lock info, and run recipe if the target needs it.  Returns BuildEvent for target. """
+        current = info.current
+        parents = info.chain[:-1]
+
+        with Trace.span('build', command.targetPath, current.script) as span, info:
+            span.args.update(info=info.filename, parent=parents[-1] if parents else '')
+
+            with Trace.span('check', command.targetPath, current.script) as checkSpan:
+                isOK, reason = self._check(info, recipe)
+                checkSpan.args['reason'] = reason
 
             def log(level: int, action: str) -> None:
-                logger.log(level, '%s %s from %s because %s', action, command.target, current.script, reason)
+                logger.log(
+                    level, '%s %s from %s because %s',
+                    action, command.target, current.script, reason,
+                )
 
             if isOK and info.last:
                 log(logging.INFO, 'Skip')
@@ -479,21 +2561,194 @@ class Builder:
             else:
                 log(logging.INFO if recipe.always else logging.WARN, 'Make')
 
+            cacheable = self._artifacts is not None and Artifacts.cacheable(recipe)
+            if cacheable and cast(Artifacts, self._artifacts).restore(
+                info, self.timestamp, lambda dep: self._checkDep(dep, info.chain)
+            ):
+                return info.current
+
             with info.build():
                 # This also updates info.current.checksum
-                envVars = {
-                    theTimestampName: date2str(self.timestamp),
-                    theDepName: path.realpath(info.filename),
-                }
-                recipe.run(command, envVars)
+                envVars = self._recipeVars(info)
+                token = self._jobs.acquire()
+                try:
+                    with self._admission.admit(info, recipe), \
+                            Trace.span('run', command.targetPath, current.script):
+                        start = time.time()
+                        recipe.run(command, envVars, workers=self._workers if token else None)
+                        info.current.duration = time.time() - start
+                finally:
+                    self._jobs.release(token)
                 info.current.refresh(self.timestamp, recipe.ignore)
 
+            if cacheable:
+                cast(Artifacts, self._artifacts).store(info)
+
             return info.current
 
+    def _recipeVars(self, info: Info) -> Dict[str, str]:
+        return {
+            theTimestampName: date2str(self.timestamp),
+            theDepName: path.realpath(info.journal),
+            theChainName: os.pathsep.join(info.chain),
+        }
+
+    def buildBatch(
+        self, commands: List[BuildCommand], parents: Optional[Tuple[FullPath, ...]] = None
+    ) -> List[BuildEvent]:
+        """ Build the targets of one +batch or +group stanza, with one run of its recipe.
+
+        A batch runs its recipe for the targets that need it, and a group runs it
+        for all its targets if any need it.  The recipe gets the targets as its
+        arguments.  Dependencies it records with GM_TARGET set to one of them
+        apply to that target, and others apply to all of them.
+
+        Returns BuildEvents for commands.
+        """
+        recipes = [self._getRecipe(command) for command in commands]
+        recipe = recipes[0]
+        parents = self._chain if parents is None else parents
+
+        infos = []
+        for command, commandRecipe in zip(commands, recipes):
+            current = BuildEvent.fromRecipe(command, commandRecipe)
+            current.timestamp = date2str(self.timestamp)
+            infos.append(Info(current, commandRecipe.ignore, parents))
+
+        results = [self._memo.get(info) for info in infos]
+        if all(results):
+            for info in infos:
+                logger.info(
+                    'Skip %s from %s because it was checked this build',
+                    info.current.target, info.current.script,
+                )
+            return cast(List[BuildEvent], results)
+
+        # A group is made together, but a batch only needs the targets not made yet
+        if recipe.outputs:
+            results = [None] * len(infos)
+        pending = [i for i, result in enumerate(results) if result is None]
+
+        # Targets of a batch can't depend on each other, since they're all locked
+        filenames = tuple(infos[i].filename for i in pending)
+        for info in infos:
+            others = tuple(f for f in filenames if f != info.filename)
+            info.chain = parents + others + (info.filename,)
+
+        with ExitStack() as stack:
+            # Lock in a fixed order, so overlapping batches can't deadlock
+            for info in sorted((infos[i] for i in pending), key=lambda info: info.filename):
+                span = stack.enter_context(
+                    Trace.span('build', info.current.targetPath, info.current.script)
+                )
+                stack.enter_context(info)
+                span.args.update(info=info.filename, parent=parents[-1] if parents else '')
+
+            reasons: Dict[int, str] = {}
+            for i in pending:
+                info = infos[i]
+                with Trace.span('check', info.current.targetPath, info.current.script) as checkSpan:
+                    isOK, reasons[i] = self._check(info, recipes[i])
+                    checkSpan.args['reason'] = reasons[i]
+                if isOK and info.last:
+                    results[i] = info.last
+
+            stale = [i for i in pending if results[i] is None]
+            if stale and recipe.outputs:
+                stale = pending
+
+            for i in pending:
+                logger.log(
+                    logging.INFO if i not in stale or recipe.always else logging.WARN,
+                    '%s %s from %s because %s', 'Make' if i in stale else 'Skip',
+                    infos[i].current.target, infos[i].current.script, reasons[i],
+                )
+
+            if stale:
+                self._runBatch([infos[i] for i in stale], [recipes[i] for i in stale], stack)
+                for i in stale:
+                    results[i] = infos[i].current
+
+        for i in pending:
+            self._memo.put(infos[i], cast(BuildEvent, results[i]))
+        return cast(List[BuildEvent], results)
+
+    def _runBatch(self, infos: List[Info], recipes: List[Recipe], stack: ExitStack) -> None:
+        """ Run the recipe once for the targets of infos, and journal each one's dependencies. """
+        recipe = recipes[0]
+        for info in infos:
+            stack.enter_context(info.build())
+
+        # Dependencies recorded without GM_TARGET apply to every target
+        shared = cast(FullPath, infos[0].journal + '.batch')
+        with open(shared, 'w') as file:
+            file.write('\t'.join(BuildEvent.header + [BuildEvent.format()]) + '\n')
+
+        try:
+            first = infos[0].current
+            envVars = {
+                theTimestampName: date2str(self.timestamp),
+                theDepName: path.realpath(shared),
+                theChainName: os.pathsep.join(infos[0].chain),
+                theBatchName: json.dumps({
+                    info.current.targetPath: path.realpath(info.journal) for info in infos
+                }),
+            }
+            targets = [info.current.target for info in infos]
+            token = self._jobs.acquire()
+            try:
+                with self._admission.admit(infos[0], recipe), \
+                        Trace.span('run', ' '.join(targets), first.script):
+                    start = time.time()
+                    recipe.run(first, envVars, targets, self._workers if token else None)
+                    duration = time.time() - start
+            finally:
+                self._jobs.release(token)
+
+            with open(shared, 'r') as file:
+                deps = [
+                    BuildEvent.fromString(line, path.dirname(shared))
+                    for line in file.readlines()[1:]
+                ]
+        finally:
+            os.remove(shared)
+
+        for info, infoRecipe in zip(infos, recipes):
+            with open(info.journal, 'a') as file:
+                for dep in deps:
+                    file.write(dep.toString(path.dirname(info.journal)) + '\n')
+            info.current.duration = duration
+            info.current.refresh(self.timestamp, infoRecipe.ignore)
+
     def _check(self, info: Info, recipe: Recipe) -> Tuple[bool, str]:
+        checked = self._checkLog(info, recipe)
+        if checked is not None:
+            return checked
+
+        # This checks for changes from outside goodmake
+        if not recipe.ignore:
+            info.current.refresh(None, False)
+            last = cast(BuildEvent, info.last)
+            if info.current.checksum and info.current.checksum != last.checksum:
+                return False, 'it changed to ' + info.current.checksum
+
+        reason = self._checkDeps(info.deps, info.chain)
+        if reason:
+            return False, reason
+
+        if self._remake:
+            return False, theRemakeName + ' environment variable is set'
+
+        return True, 'dependencies unchanged'
+
+    def _checkLog(self, info: Info, recipe: Recipe) -> Optional[Tuple[bool, str]]:
+        """ Whether the log alone shows if the target needs making, and why, or None. """
         if info.last is None:
             return False, 'it hasn\'t completed'
 
+        if info.format != BuildEvent.format():
+            return False, 'it was checked with ' + info.format
+
         # This ensures any given recipe is only run once per build
         # It will not check for side-effects
         logger.debug('last build: %s this build: %s', info.timestamp, self.timestamp)
@@ -509,42 +2764,1528 @@ class Builder:
         ):
             return False, 'its recipe changed'
 
-        # This checks for changes from outside goodmake
-        if not recipe.ignore:
-            info.current.refresh(None, False)
-            if info.current.checksum and info.current.checksum != info.last.checksum:
-                return False, 'it changed to ' + info.current.checksum
-
-        for dep in info.deps:
-            try:
-                updatedDep = self.build(dep)
-            except BuildError as e:
-                return False, dep.target + ' raised error "' + str(e) + '"'
-
-            if updatedDep.checksum and updatedDep.checksum != dep.checksum:
-                return False, dep.target + ' changed to ' + updatedDep.checksum
+        return None
+
+    def _checkDeps(self, deps: Dependencies, chain: Tuple[FullPath, ...]) -> Optional[str]:
+        """ Returns why the first changed dependency changed, or None. """
+        if not self._parallelCheck or len(deps) <= 1:
+            for dep in deps:
+                reason = self._checkDep(dep, chain)
+                if reason:
+                    return reason
+            return None
+
+        # Deps after the first known change don't need checking
+        firstChange = [len(deps)]
+        changeLock = threading.Lock()
+
+        def check(index: int) -> Optional[str]:
+            if index > firstChange[0]:
+                return None
+            reason = self._checkDep(deps[index], chain)
+            if reason:
+                with changeLock:
+                    firstChange[0] = min(firstChange[0], index)
+            return reason
+
+        # Start the longest chains of recipes first, so they don't finish last
+        order = sorted(range(len(deps)), key=lambda index: -deps.critical(index))
+        futures = {index: self._submit(check, index) for index in order}
+        try:
+            # Report in recorded order, the same as a serial check
+            for index in range(len(deps)):
+                result: Optional[str] = futures[index].result()
+                if result:
+                    return result
+            return None
+        finally:
+            for future in futures.values():
+                future.cancel()
 
-            if updatedDep.checksum in BuildEvent.nonsums:
-                if updatedDep.timestamp and updatedDep.timestamp != dep.timestamp:
-                    return False, dep.target + ' was updated ' + updatedDep.timestamp
+    def _checkDep(self, dep: BuildEvent, chain: Tuple[FullPath, ...]) -> Optional[str]:
+        """ Returns why dep changed since it was recorded, or None. """
+        try:
+            updatedDep = self.build(dep, chain)
+        except BuildError as e:
+            return dep.target + ' raised error "' + str(e) + '"'
 
-        if self._remake:
-            return False, theRemakeName + ' environment variable is set'
+        return Builder._compare(dep, updatedDep)
 
-        info.checked()
-        return True, 'dependencies unchanged'
+    @staticmethod
+    def _compare(dep: BuildEvent, updatedDep: BuildEvent) -> Optional[str]:
+        """ Returns why updatedDep differs from the recorded dep, or None. """
+        if updatedDep.checksum and updatedDep.checksum != dep.checksum:
+            return dep.target + ' changed to ' + updatedDep.checksum
 
-    def _getRecipe(self, command: BuildCommand) -> Recipe:
-        # Get an absolute, canonical path
-        scriptPath = path.realpath(command.scriptPath)
+        if updatedDep.checksum in BuildEvent.nonsums:
+            if updatedDep.timestamp and updatedDep.timestamp != dep.timestamp:
+                return dep.target + ' was updated ' + updatedDep.timestamp
 
-        with self._scriptLock:
-            if scriptPath not in self._scripts:
-                self._scripts[scriptPath] = Script(scriptPath)
+        return None
 
-        scripts = self._scripts[scriptPath]
+    def _submit(self, fn: Callable[..., Any], *args: Any) -> 'Future':
+        """ Run fn on the shared check pool, or right here if the pool is busy.
 
-        return scripts.match(command.target)
+        Running inline instead of queueing means a check waiting on its own
+        nested checks can never starve the pool.
+        """
+        if self._checkSlots.acquire(blocking=False):
+            with self._scriptLock:
+                if self._checkPool is None:
+                    self._checkPool = futures.ThreadPoolExecutor(max_workers=theMaxThreads)
+            future = self._checkPool.submit(fn, *args)
+            future.add_done_callback(lambda _: self._checkSlots.release())
+            return future
+
+        future = futures.Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def batches(self, commands: List[BuildCommand]) -> List[List[BuildCommand]]:
+        """ Group commands for the same +batch stanza, to build each group at once. """
+        units: List[List[BuildCommand]] = []
+        batches: Dict[Tuple[FullPath, str], List[BuildCommand]] = {}
+        batched: Set[FullPath] = set()
+        for command in commands:
+            try:
+                recipe = self._getRecipe(command)
+            except BuildError:
+                recipe = None
+            if recipe is None or not recipe.batch or recipe.script is None:
+                units.append([command])
+                continue
+
+            if command.targetPath in batched:
+                continue
+            batched.add(command.targetPath)
+
+            key = (path.realpath(command.scriptPath), recipe.script)
+            if key not in batches:
+                batches[key] = []
+                units.append(batches[key])
+            batches[key].append(command)
+        return units
+
+    def prewarm(self, commands: List[BuildCommand]) -> None:
+        """ Read the recorded graph under commands, and checksum its files, in parallel.
+
+        The build discovers dependencies one build log at a time, so on a cold
+        cache it waits for each read in turn.  This reads every log it can
+        reach level by level, then hashes the files into the stat cache and
+        the memo, so the build and its nested processes find them done. """
+        seen = set(command.targetPath for command in commands)
+        files: List[Tuple[FullPath, bool]] = []
+
+        with Trace.span('prewarm'), futures.ThreadPoolExecutor(max_workers=theMaxThreads) as pool:
+            level = list(commands)
+            while level:
+                found = pool.map(self._recorded, level)
+                deeper: List[BuildCommand] = []
+                for command, (source, deps) in zip(level, found):
+                    files.append((command.targetPath, source))
+                    for dep in deps:
+                        if dep.targetPath not in seen:
+                            seen.add(dep.targetPath)
+                            deeper.append(dep)
+                level = deeper
+
+            # Start reading them all before waiting on any
+            list(pool.map(Builder._readahead, [fullPath for fullPath, _ in files]))
+            list(pool.map(lambda file: self._warm(*file), files))
+
+        logger.debug('Prewarmed %d files', len(files))
+
+    def _recorded(self, command: BuildCommand) -> Tuple[bool, Iterable[BuildEvent]]:
+        """ Whether command is a source file, and its recorded dependencies. """
+        try:
+            recipe = self._getRecipe(command)
+            info = Info(BuildEvent.fromRecipe(command, recipe), recipe.ignore)
+            if info.current.stanza == 'missing':
+                return True, []
+            info.parse()
+        except (BuildError, OSError, ValueError) as e:
+            logger.debug('Not prewarming %s: %s', command.target, e)
+            return False, []
+        return False, info.deps
+
+    @staticmethod
+    def _readahead(fullPath: FullPath) -> None:
+        try:
+            st = os.stat(fullPath)
+            if not stat.S_ISREG(st.st_mode) or theStatCache.get(st) is not None:
+                return
+            fd = os.open(fullPath, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except (AttributeError, OSError):
+            pass
+        finally:
+            os.close(fd)
+
+    def _warm(self, fullPath: FullPath, source: bool) -> None:
+        if source:
+            self._memo.hashSource(fullPath)
+        else:
+            BuildEvent._hashFile(fullPath)
+
+    def expected(self, command: BuildCommand) -> Seconds:
+        """ Recorded seconds of the longest chain of recipes to make command, or 0. """
+        try:
+            recipe = self._getRecipe(command)
+            info = Info(BuildEvent.fromRecipe(command, recipe), recipe.ignore)
+            info.parse()
+        except (BuildError, OSError, ValueError) as e:
+            logger.debug('No expected time for %s: %s', command.target, e)
+            return 0
+        return (info.last.critical or 0) if info.last else 0
+
+    def _getRecipe(self, command: BuildCommand) -> Recipe:
+        # Get an absolute, canonical path
+        scriptPath = path.realpath(command.scriptPath)
+
+        with self._scriptLock:
+            if scriptPath not in self._scripts:
+                self._scripts[scriptPath] = Script.load(scriptPath)
+
+        scripts = self._scripts[scriptPath]
+
+        return scripts.match(command.target)
+
+
+class AsyncBuilder(Builder):
+
+    """ Builder that checks and makes targets as asyncio tasks, if GM_ASYNC is set.
+
+    One event loop keeps thousands of dependency checks and running recipes
+    in flight, instead of a blocked thread for each.  Recipes run as asyncio
+    subprocesses, locks are waited for without polling, and files are hashed
+    on an executor.  Dependencies are checked concurrently, like with
+    GM_PARALLEL_CHECK.  +batch and +group stanzas lock many targets at once,
+    so they are built by the threaded Builder on a worker thread. """
+
+    def __init__(self, scripts: Optional[Dict[FullPath, 'Script']] = None) -> None:
+        super(AsyncBuilder, self).__init__(scripts)
+        self._loop: Optional['asyncio.AbstractEventLoop'] = None
+        # For blocking calls that may wait on the loop, so they can't starve hashing
+        self._threads = futures.ThreadPoolExecutor(max_workers=theMaxThreads)
+        self._tasks: Set['asyncio.Future'] = set()
+
+    def close(self) -> None:
+        super(AsyncBuilder, self).close()
+        self._threads.shutdown()
+
+    def buildAll(
+        self,
+        units: List[List[BuildCommand]],
+        report: Callable[[List[BuildCommand], List[BuildEvent]], None],
+    ) -> None:
+        """ Build units concurrently, and report the events of each.
+
+        Failures set Builder.error. """
+        AsyncBuilder._watchChildren()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.set_default_executor(futures.ThreadPoolExecutor(max_workers=theMaxThreads))
+            loop.run_until_complete(self._buildAll(loop, units, report))
+        finally:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            asyncio.set_event_loop(None)
+            loop.close()
+            self._threads.shutdown()
+
+    async def _buildAll(
+        self,
+        loop: 'asyncio.AbstractEventLoop',
+        units: List[List[BuildCommand]],
+        report: Callable[[List[BuildCommand], List[BuildEvent]], None],
+    ) -> None:
+        self._loop = loop
+        # Like the threaded engine, build at most theMaxThreads top-level units at a time
+        slots = asyncio.Semaphore(theMaxThreads)
+
+        async def run(unit: List[BuildCommand]) -> None:
+            try:
+                async with slots:
+                    if Builder.error:
+                        return
+                    if len(unit) > 1:
+                        built = await self._inThread(self.buildBatch, unit)
+                    else:
+                        built = [await self.buildAsync(unit[0])]
+                report(unit, built)
+            except Exception as e:
+                logger.debug("Setting %s task error %s", os.getpid(), e)
+                Builder.fail(e)
+                for task in list(self._tasks):
+                    task.cancel()
+
+        for unit in units:
+            self._spawn(run(unit))
+
+        # Checks of dependencies after a change may still be running
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    @staticmethod
+    def _watchChildren() -> None:
+        # Before 3.12, asyncio waits for each subprocess with its own thread
+        if sys.version_info < (3, 12) and hasattr(asyncio, 'PidfdChildWatcher'):
+            try:
+                os.close(os.pidfd_open(os.getpid()))
+                asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+            except (AttributeError, OSError) as e:
+                logger.debug('Not watching subprocesses with pidfds: %s', e)
+
+    def _spawn(self, coro: Any) -> 'asyncio.Future':
+        task: 'asyncio.Future' = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task: 'asyncio.Future') -> None:
+        self._tasks.discard(task)
+        # Errors of checks no one waited for were only relevant to those checks
+        if not task.cancelled():
+            task.exception()
+
+    async def _inExecutor(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await cast('asyncio.AbstractEventLoop', self._loop).run_in_executor(
+            None, partial(fn, *args)
+        )
+
+    async def _inThread(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await cast('asyncio.AbstractEventLoop', self._loop).run_in_executor(
+            self._threads, partial(fn, *args)
+        )
+
+    def _fromThread(self, coro: Any) -> Any:
+        """ Run coro on the loop, from one of self._threads. """
+        loop = cast('asyncio.AbstractEventLoop', self._loop)
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    async def buildAsync(
+        self, command: BuildCommand, parents: Optional[Tuple[FullPath, ...]] = None
+    ) -> BuildEvent:
+        """ Like Builder.build. """
+        recipe = self._getRecipe(command)
+        current = BuildEvent.fromRecipe(command, recipe)
+
+        logger.debug('Checking %s', current)
+
+        if (recipe.outputs or recipe.batch) and recipe.script is not None:
+            return cast(BuildEvent, await self._inThread(self.build, command, parents))
+
+        if current.stanza == 'missing' and path.exists(command.targetPath):
+            logger.info('Dependency %s', command.target)
+            current.timestamp = date2str(None)
+            current.checksum = await self._inExecutor(self._memo.hashSource, command.targetPath)
+            return current
+
+        current.timestamp = date2str(self.timestamp)
+        parents = self._chain if parents is None else parents
+        info = Info(current, recipe.ignore, parents)
+
+        memoized = self._memo.get(info)
+        if memoized is not None:
+            logger.info(
+                'Skip %s from %s because it was checked this build',
+                command.target, current.script,
+            )
+            return memoized
+
+        event = await self._makeAsync(command, recipe, info)
+        self._memo.put(info, event)
+        return event
+
+    async def _makeAsync(self, command: BuildCommand, recipe: Recipe, info: Info) -> BuildEvent:
+        current = info.current
+        parents = info.chain[:-1]
+
+        with Trace.span('build', command.targetPath, current.script) as span:
+            async with info:
+                span.args.update(info=info.filename, parent=parents[-1] if parents else '')
+
+                with Trace.span('check', command.targetPath, current.script) as checkSpan:
+                    isOK, reason = await self._checkAsync(info, recipe)
+                    checkSpan.args['reason'] = reason
+
+                def log(level: int, action: str) -> None:
+                    logger.log(
+                        level, '%s %s from %s because %s',
+                        action, command.target, current.script, reason,
+                    )
+
+                if isOK and info.last:
+                    log(logging.INFO, 'Skip')
+                    return info.last
+                else:
+                    log(logging.INFO if recipe.always else logging.WARN, 'Make')
+
+                artifacts = self._artifacts
+                cacheable = artifacts is not None and Artifacts.cacheable(recipe)
+                if cacheable and await self._inThread(
+                    cast(Artifacts, artifacts).restore, info, self.timestamp,
+                    lambda dep: self._fromThread(self._checkDepAsync(dep, info.chain)),
+                ):
+                    return info.current
+
+                with info.build():
+                    envVars = self._recipeVars(info)
+                    token = await self._jobs.acquireAsync()
+                    try:
+                        admitted = await self._admission.admitAsync(info, recipe)
+                        try:
+                            with Trace.span('run', command.targetPath, current.script):
+                                start = time.time()
+                                if token and self._workers is not None:
+                                    await self._inThread(
+                                        recipe.run, command, envVars, None, self._workers
+                                    )
+                                else:
+                                    await recipe.runAsync(command, envVars)
+                                info.current.duration = time.time() - start
+                        finally:
+                            if admitted:
+                                self._admission.leave(info)
+                    finally:
+                        self._jobs.release(token)
+                    await self._inExecutor(info.current.refresh, self.timestamp, recipe.ignore)
+
+                if cacheable:
+                    await self._inThread(cast(Artifacts, artifacts).store, info)
+
+                return info.current
+
+    async def _checkAsync(self, info: Info, recipe: Recipe) -> Tuple[bool, str]:
+        checked = self._checkLog(info, recipe)
+        if checked is not None:
+            return checked
+
+        if not recipe.ignore:
+            await self._inExecutor(info.current.refresh, None, False)
+            last = cast(BuildEvent, info.last)
+            if info.current.checksum and info.current.checksum != last.checksum:
+                return False, 'it changed to ' + info.current.checksum
+
+        reason = await self._checkDepsAsync(info.deps, info.chain)
+        if reason:
+            return False, reason
+
+        if self._remake:
+            return False, theRemakeName + ' environment variable is set'
+
+        return True, 'dependencies unchanged'
+
+    async def _checkDepsAsync(
+        self, deps: Dependencies, chain: Tuple[FullPath, ...]
+    ) -> Optional[str]:
+        # Deps after the first known change don't need checking
+        firstChange = [len(deps)]
+
+        async def check(index: int) -> Optional[str]:
+            if index > firstChange[0]:
+                return None
+            reason = await self._checkDepAsync(deps[index], chain)
+            if reason:
+                firstChange[0] = min(firstChange[0], index)
+            return reason
+
+        # Start the longest chains of recipes first, so they don't finish last
+        order = sorted(range(len(deps)), key=lambda index: -deps.critical(index))
+        checks: Dict[int, 'asyncio.Future'] = {}
+        for index in order:
+            if len(self._tasks) < theAsyncChecks:
+                checks[index] = self._spawn(check(index))
+            else:
+                # Check inline, so memory stays bounded
+                checks[index] = cast('asyncio.AbstractEventLoop', self._loop).create_future()
+                checks[index].set_result(await check(index))
+
+        try:
+            # Report in recorded order, the same as a serial check
+            for index in range(len(deps)):
+                result: Optional[str] = await checks[index]
+                if result:
+                    return result
+            return None
+        finally:
+            pending = [task for task in checks.values() if not task.done()]
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    async def _checkDepAsync(self, dep: BuildEvent, chain: Tuple[FullPath, ...]) -> Optional[str]:
+        try:
+            updatedDep = await self.buildAsync(dep, chain)
+        except BuildError as e:
+            return dep.target + ' raised error "' + str(e) + '"'
+
+        return Builder._compare(dep, updatedDep)
+
+
+class Query(Builder):
+
+    """ Finds which targets a build would make, and why, without making them.
+
+    Walks the recorded build info with the same checks as Builder, but
+    takes no locks, runs no recipes, and writes no build info.  Each
+    target is checked once, and recorded dependencies are hashed in
+    parallel.  A dependency that would be made makes its parents stale. """
+
+    def __init__(self) -> None:
+        super(Query, self).__init__()
+        # Nothing was checked "this build", since a query isn't one
+        self.timestamp = datetime.max
+        self._parallelCheck = True
+        self._results: Dict[FullPath, 'Future'] = {}
+        self._resultsLock = threading.Lock()
+        self.stale: List[Tuple[FullPath, str, str]] = []
+
+    def build(
+        self, command: BuildCommand, parents: Optional[Tuple[FullPath, ...]] = None
+    ) -> BuildEvent:
+        return self.query(command, parents)[0]
+
+    def query(
+        self, command: BuildCommand, parents: Optional[Tuple[FullPath, ...]] = None
+    ) -> Tuple[BuildEvent, Optional[str]]:
+        """ Returns the BuildEvent for command, and why it would be made or None. """
+        recipe = self._getRecipe(command)
+        current = BuildEvent.fromRecipe(command, recipe)
+
+        if current.stanza == 'missing' and path.exists(command.targetPath):
+            key = command.targetPath
+            info = None
+        else:
+            info = Info(current, recipe.ignore, self._chain if parents is None else parents)
+            key = info.filename
+            info.checkCycle()
+
+        with self._resultsLock:
+            existing = self._results.get(key)
+            if existing is None:
+                future = self._results[key] = futures.Future()
+
+        if existing is not None:
+            return cast(Tuple[BuildEvent, Optional[str]], existing.result())
+
+        try:
+            result = self._query(command, recipe, current, info)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def _query(
+        self, command: BuildCommand, recipe: Recipe, current: BuildEvent, info: Optional[Info]
+    ) -> Tuple[BuildEvent, Optional[str]]:
+        if info is None:
+            logger.info('Dependency %s', command.target)
+            current.refresh()
+            return current, None
+
+        current.timestamp = date2str(self.timestamp)
+        try:
+            info.parse()
+            isOK, reason = self._check(info, recipe)
+        except BuildError as e:
+            isOK, reason = False, str(e)
+
+        if isOK and info.last:
+            logger.info('Skip %s from %s because %s', command.target, current.script, reason)
+            return info.last, None
+
+        if recipe.script is None:
+            # Making it would fail, as in Recipe._prepare
+            raise BuildError("No recipe for " + command.target)
+
+        with self._resultsLock:
+            self.stale.append((command.targetPath, current.script, reason))
+        return current, reason
+
+    def _checkDep(self, dep: BuildEvent, chain: Tuple[FullPath, ...]) -> Optional[str]:
+        try:
+            reason = self.query(dep, chain)[1]
+        except BuildError as e:
+            return dep.target + ' raised error "' + str(e) + '"'
+        if reason:
+            return dep.target + ' would be made'
+        return super(Query, self)._checkDep(dep, chain)
+
+
+class Graph:
+
+    """ The recorded dependencies of targets, kept in memory by --watch. """
+
+    def __init__(self) -> None:
+        # Targets made by recipes, with the dependencies their recipes used
+        self.deps: Dict[FullPath, List[FullPath]] = {}
+        self.parents: Dict[FullPath, Set[FullPath]] = {}
+        # Last recorded checksum of every target and dependency
+        self.checksums: Dict[FullPath, Optional[Hash]] = {}
+        self.commands: Dict[FullPath, BuildCommand] = {}
+        # Shebang recipes may depend on anything, like the files in a directory
+        self.always: Set[FullPath] = set()
+
+    def add(self, targetPath: FullPath, last: BuildEvent, deps: Iterable[BuildEvent]) -> None:
+        for depPath in self.deps.get(targetPath, []):
+            self.parents[depPath].discard(targetPath)
+        deps = list(deps)
+        self.deps[targetPath] = [dep.targetPath for dep in deps]
+        for dep in deps:
+            self.parents.setdefault(dep.targetPath, set()).add(targetPath)
+            self.commands.setdefault(dep.targetPath, dep)
+            if dep.targetPath not in self.deps:
+                self.checksums[dep.targetPath] = dep.checksum
+        self.checksums[targetPath] = last.checksum
+
+    def dirs(self) -> Set[FullPath]:
+        return set(path.dirname(p) for p in self.checksums)
+
+    def affected(self, changed: Iterable[FullPath]) -> Set[FullPath]:
+        """ Changed paths that differ from how they were recorded, or shebang
+        targets if other files changed. """
+        affected: Set[FullPath] = set()
+        for fullPath in changed:
+            if fullPath not in self.checksums:
+                affected |= self.always
+            elif BuildEvent._hashFile(fullPath) != self.checksums[fullPath]:
+                affected.add(fullPath)
+        return affected
+
+    def cone(self, changed: Iterable[FullPath]) -> Set[FullPath]:
+        """ The changed paths, and everything that depends on them. """
+        cone: Set[FullPath] = set()
+        pending = list(changed)
+        while pending:
+            fullPath = pending.pop()
+            if fullPath not in cone:
+                cone.add(fullPath)
+                pending.extend(self.parents.get(fullPath, ()))
+        return cone
+
+
+class WatchBuilder(Builder):
+
+    """ Builds only the part of a Graph that changed, and learns new edges.
+
+    A recorded dependency outside the cone of changes is returned as it
+    was recorded, without locking, checking, or hashing it.  The cone is
+    None when everything must be checked. """
+
+    def __init__(self, graph: Graph, cone: Optional[Set[FullPath]]) -> None:
+        super(WatchBuilder, self).__init__()
+        self._graph = graph
+        self._cone = cone
+
+    def build(
+        self, command: BuildCommand, parents: Optional[Tuple[FullPath, ...]] = None
+    ) -> BuildEvent:
+        if (
+            self._cone is not None and isinstance(command, BuildEvent) and
+            command.targetPath in self._graph.checksums and command.targetPath not in self._cone
+        ):
+            return command
+        return super(WatchBuilder, self).build(command, parents)
+
+    def learn(self, commands: List[BuildCommand]) -> None:
+        """ Read the build info of commands, and of dependencies not yet in the graph. """
+        pending = list(commands)
+        seen: Set[FullPath] = set()
+        while pending:
+            command = pending.pop()
+            if command.targetPath in seen:
+                continue
+            seen.add(command.targetPath)
+
+            recipe = self._getRecipe(command)
+            current = BuildEvent.fromRecipe(command, recipe)
+            if current.stanza == 'missing':
+                continue
+
+            info = Info(current, recipe.ignore)
+            try:
+                info.parse()
+            except BuildError as e:
+                logger.debug('Not watching %s: %s', command.target, e)
+                continue
+            if info.last is None:
+                continue
+
+            self._graph.add(command.targetPath, info.last, info.deps)
+            if recipe.always:
+                self._graph.always.add(command.targetPath)
+            pending.extend(dep for dep in info.deps if dep.targetPath not in self._graph.deps)
+
+
+class Watcher:
+
+    """ Linux inotify on directories, through ctypes. """
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+
+    _mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _header = struct.Struct('iIII')
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(ctypesUtil.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs: Dict[int, FullPath] = {}
+        self._watched: Set[FullPath] = set()
+
+    def add(self, dirPath: FullPath) -> None:
+        if dirPath in self._watched:
+            return
+        wd = self._libc.inotify_add_watch(self._fd, dirPath.encode('utf-8'), self._mask)
+        if wd < 0:
+            # It will be added once a build creates it
+            logger.debug('Not watching %s: %s', dirPath, os.strerror(ctypes.get_errno()))
+            return
+        self._dirs[wd] = dirPath
+        self._watched.add(dirPath)
+
+    def drain(self) -> Optional[Set[FullPath]]:
+        """ Return the paths changed since the last wait, without waiting. """
+        changed: Optional[Set[FullPath]] = set()
+        while changed is not None and select.select([self._fd], [], [], 0)[0]:
+            changes = self._read()
+            changed = None if changes is None else changed | changes
+        return changed
+
+    def wait(self) -> Optional[Set[FullPath]]:
+        """ Wait for changes, and return the changed paths, or None if events were lost. """
+        changed: Optional[Set[FullPath]] = set()
+        deadline = None
+        while True:
+            timeout = (
+                None if deadline is None
+                else max(0, min(theWatchDelay, deadline - time.time()))
+            )
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if not ready:
+                if deadline is not None:
+                    return changed
+                continue
+
+            if deadline is None:
+                deadline = time.time() + theWatchMaxDelay
+            changes = self._read()
+            changed = None if changes is None or changed is None else changed | changes
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def _read(self) -> Optional[Set[FullPath]]:
+        changed: Set[FullPath] = set()
+        lost = False
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._header.unpack_from(data, offset)
+            offset += self._header.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                lost = True
+            elif mask & self.IN_IGNORED:
+                self._watched.discard(self._dirs.pop(wd, cast(FullPath, '')))
+            elif wd in self._dirs:
+                changed.add(path.join(self._dirs[wd], name))
+
+        return None if lost else changed
+
+
+class Daemon:
+
+    """ Per-build server for nested goodmake invocations.
+
+    The top-level goodmake forks the server before building.  Nested
+    invocations send their arguments, environment, and stdio descriptors
+    over a Unix socket, and the server forks a copy of itself to build them.
+    The forks start with the server's parsed scripts, and skip interpreter
+    startup and imports.  Requests with different GM_ settings are declined,
+    and the client builds them itself. """
+
+    # Variables that legitimately differ between invocations of one build
+    _internal = [theDepName, theChainName, theBatchName, theTargetName]
+
+    def __init__(self, timestamp: str):
+        self.socketPath = Daemon.path(timestamp)
+        self.pid: Optional[int] = None
+        self._scripts: Dict[FullPath, Tuple[str, Script]] = {}
+
+    @staticmethod
+    def path(timestamp: str) -> FullPath:
+        key = hashString('%s %s' % (os.getuid(), timestamp), 'md5')
+        return path.join(cast(FullPath, tempfile.gettempdir()), 'goodmake-%s.sock' % key)
+
+    @staticmethod
+    def _settings(env: Dict[str, str]) -> Dict[str, str]:
+        return {
+            k: v for k, v in env.items()
+            if (k.startswith('GM_') or k == theLogName) and k not in Daemon._internal
+        }
+
+    @staticmethod
+    def forward(argv: List[str]) -> Optional[int]:
+        """ Ask the build's daemon to run argv.  Returns None if we should build it ourselves. """
+        timestamp = os.environ.get(theTimestampName)
+        if timestamp is None or not env2bool(theDaemonName):
+            return None
+
+        socketPath = Daemon.path(timestamp)
+        if not path.exists(socketPath):
+            return None
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            try:
+                conn.connect(socketPath)
+            except OSError as e:
+                logger.debug('No daemon at %s: %s', socketPath, e)
+                return None
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            request = json.dumps({'cwd': os.getcwd(), 'argv': argv, 'env': dict(os.environ)})
+            conn.sendmsg(
+                [b'\n'],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', [0, 1, 2]))],
+            )
+            conn.sendall(request.encode('utf-8') + b'\n')
+
+            reply = json.loads(conn.makefile('rb').read().decode('utf-8') or '{}')
+
+        if 'returncode' not in reply:
+            logger.debug('Daemon declined %s', argv[3:])
+            return None
+
+        for line in reply['events']:
+            logger.debug('Daemon built %s', line)
+        return int(reply['returncode'])
+
+    def start(self) -> None:
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socketPath)
+        # Clients can't connect until we listen, and requests run as us
+        os.chmod(self.socketPath, 0o600)
+        server.listen(64)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                self._serve(server)
+            finally:
+                os._exit(0)
+
+        server.close()
+        logger.debug('Started daemon %d at %s', self.pid, self.socketPath)
+
+    def stop(self) -> None:
+        if self.pid is None:
+            return
+
+        logger.debug('Stopping daemon %d', self.pid)
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        os.remove(self.socketPath)
+        self.pid = None
+
+    def _serve(self, server: 'socket.socket') -> None:
+        # Don't hold the top-level's output open
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+
+        # Reap forked requests automatically
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        settings = Daemon._settings(dict(os.environ))
+
+        while True:
+            conn, _ = server.accept()
+            fds: List[int] = []
+            try:
+                if Daemon._peerUid(conn) != os.getuid():
+                    continue
+
+                _, ancdata, _, _ = conn.recvmsg(1, socket.CMSG_LEN(3 * array('i').itemsize))
+                for level, kind, data in ancdata:
+                    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                        fds.extend(array('i', data[:len(data) - len(data) % 4]))
+                request = json.loads(conn.makefile('rb').readline().decode('utf-8'))
+
+                if len(fds) != 3 or Daemon._settings(request['env']) != settings:
+                    continue
+
+                scripts = self._loadScript(request['cwd'], request['argv'][2])
+
+                if os.fork() == 0:
+                    server.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    self._handle(conn, request, fds, scripts)
+            except Exception:
+                pass  # The client will build it itself
+            finally:
+                conn.close()
+                for fd in fds:
+                    os.close(fd)
+
+    @staticmethod
+    def _peerUid(conn: 'socket.socket') -> int:
+        credentials = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return cast(int, struct.unpack('3i', credentials)[1])
+
+    def _loadScript(self, currentDir: FullPath, script: str) -> Dict[FullPath, 'Script']:
+        """ Parse the requested script once, to be inherited by each fork. """
+        scriptPath = path.realpath(str2path(script, currentDir))
+        try:
+            fingerprint = StatCache.fingerprint(os.stat(scriptPath))
+            if self._scripts.get(scriptPath, ('', None))[0] != fingerprint:
+                self._scripts[scriptPath] = (fingerprint, Script.load(scriptPath))
+        except (OSError, BuildError):
+            self._scripts.pop(scriptPath, None)
+        return {k: v[1] for k, v in self._scripts.items()}
+
+    def _handle(
+        self, conn: 'socket.socket', request: Dict[str, Any], fds: List[int],
+        scripts: Dict[FullPath, 'Script']
+    ) -> None:
+        returncode = 1
+        events: List[str] = []
+        try:
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+
+            returncode = build(request['argv'], scripts, events)
+        except Exception as e:
+            logger.error(e)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                reply = {'returncode': returncode, 'events': events}
+                conn.sendall(json.dumps(reply).encode('utf-8'))
+            finally:
+                os._exit(0)
+
+
+class WorkerPool:
+
+    """ Runs recipes on the workers in GM_WORKERS, which share our filesystem.
+
+    GM_WORKERS lists the host:port addresses of `--worker` servers.  A recipe
+    that runs with a token from the jobserver is sent to one of them as its
+    directory, interpreter, arguments, stanza, and the GM_ variables it was
+    given.  The worker replies with its exit code, output, and the checksums
+    of its targets, which must match what we see here.  Recipes run with a
+    process's implicit token stay local, so recipes waiting on nested
+    invocations never hold all the workers' slots.
+
+    Each connection starts by sending the shared secret in GM_WORKER_TOKEN.
+    Workers are tried in a random order weighted by their slots.  A full
+    worker declines the recipe, and when all are full we wait and try again.
+    A worker that doesn't answer is lost for the rest of this process, and
+    its recipe is retried on another, or run here if none are left. """
+
+    def __init__(self, addresses: List[str], token: str):
+        self.addresses = addresses
+        self._token = token
+        self._slots: Dict[str, int] = {}
+        self._lost: Set[str] = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fromEnv() -> Optional['WorkerPool']:
+        addresses = os.environ.get(theWorkersName, '').replace(',', ' ').split()
+        return WorkerPool(addresses, os.environ.get(theWorkerTokenName, '')) if addresses else None
+
+    @staticmethod
+    def parse(address: str) -> Tuple[str, int]:
+        host, _, port = address.rpartition(':')
+        return host or 'localhost', int(port)
+
+    def slots(self) -> int:
+        """ Total slots of the workers that answer. """
+        for address in self.addresses:
+            try:
+                with self._connect(address) as conn:
+                    self._status(address, conn)
+            except (OSError, ValueError) as e:
+                self._lose(address, e)
+        return sum(self._slots.get(address, 0) for address in self._order())
+
+    def run(
+        self, dirPath: FullPath, args: List[str], recipe: Recipe, env: Dict[str, str],
+        targets: List[str],
+    ) -> Optional[int]:
+        """ Run a recipe on a worker.  Returns its exit code, or None if no workers are left. """
+        job = json.dumps({
+            'cwd': dirPath,
+            'executable': recipe.interpreter[0],
+            'args': args,
+            'script': recipe.script,
+            'env': {k: v for k, v in env.items() if k.startswith('GM_') or k == theLogName},
+            'targets': targets,
+        }).encode('utf-8') + b'\n'
+
+        delay = .01
+        while True:
+            addresses = self._order()
+            if not addresses:
+                logger.warning('No workers left, running %s here', ' '.join(targets))
+                return None
+
+            for address in addresses:
+                Builder.sleep(0)
+                try:
+                    reply = self._send(address, job)
+                except (OSError, ValueError) as e:
+                    Builder.sleep(0)
+                    self._lose(address, e)
+                    continue
+                if reply is not None:
+                    return self._finish(address, dirPath, reply)
+
+            Builder.sleep(delay)
+            delay = min(2 * delay, theWorkerRetry)
+
+    def _order(self) -> List[str]:
+        # Weighted random order (Efraimidis-Spirakis), so bigger workers get more recipes
+        with self._lock:
+            live = [address for address in self.addresses if address not in self._lost]
+            return sorted(
+                live, key=lambda address: -random.random() ** (1 / self._slots.get(address, 1))
+            )
+
+    def _lose(self, address: str, error: Exception) -> None:
+        logger.warning('Lost worker %s: %s', address, error)
+        with self._lock:
+            self._lost.add(address)
+
+    def _connect(self, address: str) -> 'socket.socket':
+        conn = socket.create_connection(WorkerPool.parse(address), theWorkerTimeout)
+        try:
+            conn.sendall(json.dumps({'token': self._token}).encode('utf-8') + b'\n')
+        except OSError:
+            conn.close()
+            raise
+        return conn
+
+    def _status(self, address: str, conn: 'socket.socket') -> bool:
+        """ Read the worker's greeting, and return whether it took a slot for us. """
+        line = conn.makefile('rb').readline()
+        if not line:
+            raise ValueError('closed the connection')
+        status = json.loads(line.decode('utf-8'))
+        if 'error' in status:
+            raise ValueError(status['error'])
+        with self._lock:
+            self._slots[address] = int(status['slots'])
+        return bool(status['accepted'])
+
+    def _send(self, address: str, job: bytes) -> Optional[Dict[str, Any]]:
+        """ Run job on a worker.  Returns its reply, or None if the worker is full. """
+        with self._connect(address) as conn:
+            if not self._status(address, conn):
+                return None
+
+            conn.sendall(job)
+            # Recipes can run for as long as they like
+            conn.settimeout(None)
+            Builder.started(conn)
+            try:
+                line = conn.makefile('rb').readline()
+            finally:
+                Builder.finished(conn)
+
+        if not line:
+            raise ValueError('closed the connection while running a recipe')
+        return cast(Dict[str, Any], json.loads(line.decode('utf-8')))
+
+    @staticmethod
+    def _finish(address: str, dirPath: FullPath, reply: Dict[str, Any]) -> int:
+        for name, stream in [('stdout', sys.stdout), ('stderr', sys.stderr)]:
+            output = base64.b64decode(reply[name])
+            if output:
+                stream.flush()
+                stream.buffer.write(output)
+                stream.buffer.flush()
+
+        returncode = int(reply['returncode'])
+        if returncode == 0:
+            for target, checksum in reply['checksums'].items():
+                local = BuildEvent._hashFile(str2path(target, dirPath))
+                if local != checksum:
+                    raise BuildError(
+                        '%s is %s on worker %s, but %s here.  Workers must share our files.' % (
+                            target, checksum, address, local
+                        )
+                    )
+        return returncode
+
+
+class Worker:
+
+    """ Server that runs recipes for the WorkerPool of other goodmakes.
+
+    Each connection first sends the worker's GM_WORKER_TOKEN, and is
+    dropped with an error if it doesn't match.  Then it's greeted with the
+    worker's slots, and whether it got one.  If so, it sends one job, and
+    gets one reply when the recipe ends.  If the connection closes first,
+    the recipe is killed. """
+
+    def __init__(self, address: str, slots: int, token: str):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(WorkerPool.parse(address))
+        self.server.listen(64)
+        host, port = self.server.getsockname()[:2]
+        self.address = '%s:%d' % (host, port)
+        self.slots = slots
+        self._token = token
+        self._free = threading.BoundedSemaphore(slots)
+        self.pid: Optional[int] = None
+
+    def start(self) -> None:
+        """ Serve from a fork. """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                self.serve()
+            finally:
+                os._exit(0)
+        self.server.close()
+
+    def stop(self) -> None:
+        if self.pid is None:
+            return
+
+        logger.debug('Stopping worker %d at %s', self.pid, self.address)
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        self.pid = None
+
+    def serve(self) -> None:
+        logger.info('Worker at %s with %d slots', self.address, self.slots)
+        while True:
+            conn, _ = self.server.accept()
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn: 'socket.socket') -> None:
+        accepted = False
+        try:
+            with conn:
+                reader = conn.makefile('rb')
+                if not self._authorized(reader.readline()):
+                    logger.warning('Rejected a connection with the wrong %s', theWorkerTokenName)
+                    error = {'error': 'wrong %s' % theWorkerTokenName}
+                    conn.sendall(json.dumps(error).encode('utf-8') + b'\n')
+                    return
+
+                accepted = self._free.acquire(blocking=False)
+                status = {'slots': self.slots, 'accepted': accepted}
+                conn.sendall(json.dumps(status).encode('utf-8') + b'\n')
+                if not accepted:
+                    return
+
+                line = reader.readline()
+                if line:
+                    reply = self._run(conn, json.loads(line.decode('utf-8')))
+                    conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+                # Wakes _watch
+                conn.shutdown(socket.SHUT_RDWR)
+        except (OSError, ValueError) as e:
+            logger.debug('Worker connection failed: %s', e)
+        finally:
+            if accepted:
+                self._free.release()
+
+    def _authorized(self, line: bytes) -> bool:
+        try:
+            token = json.loads(line.decode('utf-8'))['token']
+        except (ValueError, KeyError, TypeError):
+            return False
+        return isinstance(token, str) and hmac.compare_digest(
+            token.encode('utf-8'), self._token.encode('utf-8')
+        )
+
+    def _run(self, conn: 'socket.socket', job: Dict[str, Any]) -> Dict[str, Any]:
+        env = {k: v for k, v in os.environ.items() if not k.startswith('GM_')}
+        env.update(job['env'])
+        logger.debug('Running %s in %s', job['args'], job['cwd'])
+
+        try:
+            process = subprocess.Popen(
+                job['args'],
+                executable=job['executable'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
+                cwd=job['cwd'],
+                # So the whole recipe can be killed
+                start_new_session=True,
+            )
+        except OSError as e:
+            error = ('%s\n' % e).encode('utf-8')
+            return {
+                'returncode': 127, 'stdout': '', 'stderr': Worker._encode(error), 'checksums': {},
+            }
+
+        threading.Thread(target=Worker._watch, args=(conn, process), daemon=True).start()
+        stdout, stderr = process.communicate(job['script'].encode('utf-8'))
+
+        checksums = {
+            target: BuildEvent._hashFile(str2path(target, job['cwd'])) for target in job['targets']
+        } if process.returncode == 0 else {}
+
+        return {
+            'returncode': process.returncode,
+            'stdout': Worker._encode(stdout),
+            'stderr': Worker._encode(stderr),
+            'checksums': checksums,
+        }
+
+    @staticmethod
+    def _watch(conn: 'socket.socket', process: 'subprocess.Popen') -> None:
+        # Clients send nothing more, so this returns when they hang up, or when we do
+        try:
+            conn.recv(1)
+        except OSError:
+            pass
+        if process.poll() is None:
+            logger.debug('Client hung up, killing %s', process.args)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    @staticmethod
+    def _encode(data: bytes) -> str:
+        return base64.b64encode(data).decode('ascii')
+
+
+class Cleaner:
+
+    """ Lists or deletes built targets and their build logs.
+
+    A target is only deleted if it still is what GoodMake built: modified
+    after its build started, not since it was last checked, and with its
+    recorded checksum.  Nothing newer than the current build is touched. """
+
+    def __init__(self, force: bool, orphans: bool):
+        self.force = force
+        self.orphans = orphans
+        self.start = str2date(os.environ.get(theTimestampName, 'now')).timestamp()
+        self._store = infoStore()
+
+    def clean(self, dirPaths: List[FullPath]) -> None:
+        with futures.ThreadPoolExecutor(max_workers=theMaxThreads) as pool:
+            infos, locks = self._store.scan(pool, dirPaths)
+
+            for lockname, modified in sorted(locks):
+                if modified < self.start:
+                    self._remove(lockname)
+
+            infos = sorted(info for info in infos if info[1] < self.start)
+            for i in range(0, len(infos), theCleanBatch):
+                for found in pool.map(self._check, infos[i:i + theCleanBatch]):
+                    # Warn here, so warnings come in order with what's removed
+                    if isinstance(found, str):
+                        logger.warning(found)
+                    if found is None or isinstance(found, str):
+                        continue
+                    filename, target = found
+                    self._remove(filename, info=True)
+                    if target is not None:
+                        self._remove(*target)
+
+    def _check(
+        self, info: Tuple[FullPath, float]
+    ) -> Union[Tuple[FullPath, Optional[Tuple[FullPath, os.stat_result]]], str, None]:
+        """ The info, and the target with its stat, to remove.  Or why to keep both, or None. """
+        filename, checked = info
+        dirPath, basename = path.split(filename)
+        target = path.join(dirPath, basename[1:-len('.gm')])
+
+        try:
+            st = os.stat(target)
+        except FileNotFoundError:
+            return filename, None
+        if self.orphans:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return filename, None
+
+        try:
+            loaded = Info.load(self._store, filename, dirPath)
+            last = loaded[1] if loaded else None
+            built = (
+                str2date(last.timestamp).timestamp()
+                if last and last.timestamp not in [None, '', 'None'] else None
+            )
+        except (IndexError, ValueError) as e:
+            return '%s is not a GoodMake log: %s' % (path2str(filename, os.getcwd()), e)
+        if loaded is None or last is None or built is None:
+            return None
+
+        # Compare whole seconds, as file systems may not keep more
+        name = path2str(target, os.getcwd())
+        if int(st.st_mtime) < int(built):
+            return '%s pre-dates GoodMake build' % name
+        elif int(st.st_mtime) > int(checked):
+            return '%s modified after GoodMake check' % name
+        elif loaded[0] != BuildEvent.format() or BuildEvent._hashFile(target) != last.checksum:
+            return "%s doesn't match GoodMake build" % name
+        return filename, (target, st)
+
+    def _remove(
+        self, fullPath: FullPath, st: Optional[os.stat_result] = None, info: bool = False
+    ) -> None:
+        if st is not None:
+            # Don't delete a target changed since it was checked
+            try:
+                current = os.stat(fullPath)
+            except FileNotFoundError:
+                return
+            if (current.st_mtime_ns, current.st_size) != (st.st_mtime_ns, st.st_size):
+                logger.warning('%s modified after GoodMake check', path2str(fullPath, os.getcwd()))
+                return
+
+        print(path2str(fullPath, os.getcwd()), flush=True)
+        if not self.force:
+            return
+        if info:
+            self._store.remove(fullPath)
+        else:
+            try:
+                os.remove(fullPath)
+            except FileNotFoundError:
+                pass
+
+
+def watchTargets(scriptPath: str, targets: List[str]) -> int:
+    """ Build targets, then rebuild them whenever their dependencies change. """
+    try:
+        watcher = Watcher()
+    except (AttributeError, OSError) as e:
+        logger.error('Can\'t watch files: %s', e)
+        return 1
+
+    currentDir = os.getcwd()
+    targets = targets or ['default']
+    commands = [BuildCommand(currentDir, scriptPath, target) for target in targets]
+    realScriptPath = path.realpath(str2path(scriptPath, currentDir))
+    graph = Graph()
+    cone: Optional[Set[FullPath]] = None
+
+    try:
+        while True:
+            Builder.error = None
+            with topLevel():
+                builder = WatchBuilder(graph, cone)
+                try:
+                    returncode = build([sys.argv[0], '', scriptPath] + targets, builder=builder)
+                finally:
+                    builder.close()
+            builder.learn(commands + [
+                graph.commands[p] for p in (cone or ()) if p in graph.deps and p in graph.commands
+            ])
+
+            for dirPath in graph.dirs() | {path.dirname(realScriptPath)}:
+                watcher.add(dirPath)
+            logger.warning(
+                '%s.  Watching %d files for changes.',
+                'Build failed' if returncode else 'Built', len(graph.checksums)
+            )
+
+            # Our own writes during the build only count if they're not what was recorded
+            changed = watcher.drain()
+            cone = graph.cone(
+                p for p in changed if p in graph.checksums and graph.affected([p])
+            ) if changed is not None else None
+
+            while cone is not None and not cone:
+                changed = watcher.wait()
+                if changed is None or realScriptPath in changed:
+                    cone = None
+                else:
+                    cone = graph.cone(graph.affected(changed))
+            logger.info('Rebuilding %d targets', len(cone or graph.checksums))
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+def artifactStats(scriptPath: str, args: List[str]) -> int:
+    """ Print the size and hit rate of the GM_ARTIFACTS cache. """
+    artifacts = Artifacts.fromEnv()
+    if artifacts is None:
+        logger.error('Set %s to use an artifact cache', theArtifactsName)
+        return 1
+
+    stats = artifacts.stats()
+    lookups = stats.get('hit', 0) + stats.get('miss', 0)
+    print('Artifact cache %s' % artifacts.dirPath)
+    print('%d targets, %.1f of %.1f MiB, %d manifests' % (
+        stats['objects'], stats['bytes'] / (1 << 20), stats['limit'] / (1 << 20), stats['manifests']
+    ))
+    print('%d hits, %d misses (%.0f%%), %d stored, %d evicted' % (
+        stats.get('hit', 0), stats.get('miss', 0), 100.0 * stats.get('hit', 0) / max(lookups, 1),
+        stats.get('store', 0), stats.get('evict', 0),
+    ))
+    return 0
+
+
+def cleanTargets(scriptPath: str, args: List[str]) -> int:
+    """ List built targets and logs under directories, or delete them with -f. """
+    force = orphans = False
+    dirPaths: List[FullPath] = []
+    for arg in args:
+        if arg in ['-f', '--force']:
+            force = True
+        elif arg == '--orphans':
+            orphans = True
+        elif arg.startswith('-'):
+            logger.error('Unknown --clean option %s.  Use -f, --force, or --orphans', arg)
+            return 1
+        else:
+            dirPaths.append(path.abspath(arg))
+
+    Cleaner(force, orphans).clean(dirPaths or [path.abspath('.')])
+    return 0
+
+
+def importInfo(scriptPath: str, dirPaths: List[str]) -> int:
+    """ Copy .gm files under dirPaths into the GM_DATABASE. """
+    store = infoStore()
+    if not isinstance(store, InfoDatabase):
+        logger.error('Set %s to import build info into a database', theDatabaseName)
+        return 1
+
+    count = 0
+    for dirPath in dirPaths or ['.']:
+        for root, dirs, files in os.walk(dirPath):
+            for name in files:
+                if name.startswith('.') and name.endswith('.gm'):
+                    filename = path.abspath(path.join(cast(FullPath, root), name))
+                    with open(filename, 'r') as info:
+                        store.put(filename, info.read(), path.getmtime(filename))
+                    count += 1
+
+    logger.warning('Imported %d build logs into %s', count, store.database)
+    return 0
+
+
+def serveWorker(scriptPath: str, args: List[str]) -> int:
+    """ Run recipes sent by goodmakes with this [host:]port in GM_WORKERS. """
+    if not 1 <= len(args) <= 2:
+        logger.error('Use --worker [host:]port [slots]')
+        return 1
+
+    token = os.environ.get(theWorkerTokenName)
+    if not token:
+        logger.error(
+            'Set %s to a secret shared with the builds that use this worker', theWorkerTokenName
+        )
+        return 1
+
+    try:
+        worker = Worker(args[0], int(args[1]) if len(args) > 1 else os.cpu_count() or 1, token)
+        worker.serve()
+    except KeyboardInterrupt:
+        return 0
+    except (OSError, ValueError) as e:
+        logger.error('Can\'t run worker at %s: %s', args[0], e)
+        return 1
+    return 0
+
+
+def localWorkers(scriptPath: str, args: List[str]) -> int:
+    """ Build targets with count workers on localhost, as if they were remote. """
+    if not args or not args[0].isdigit() or int(args[0]) < 1:
+        logger.error('Use --workers count [target...]')
+        return 1
+
+    count = int(args[0])
+    slots = max(1, (os.cpu_count() or 1) // count)
+    token = os.environ[theWorkerTokenName] = os.urandom(16).hex()
+    with ExitStack() as stack:
+        workers = []
+        for _ in range(count):
+            worker = Worker('127.0.0.1:0', slots, token)
+            worker.start()
+            stack.callback(worker.stop)
+            workers.append(worker.address)
+
+        os.environ[theWorkersName] = ' '.join(workers)
+        logger.info('Building with %d local workers: %s', count, os.environ[theWorkersName])
+        with topLevel():
+            return build([sys.argv[0], '', scriptPath] + args[1:])
+
+
+def queryTargets(scriptPath: str, targets: List[str]) -> int:
+    """ Print which targets would be made, and why.  Returns 1 if any would. """
+    currentDir = os.getcwd()
+    query = Query()
+
+    def run(target: str) -> None:
+        query.query(BuildCommand(currentDir, scriptPath, target))
+
+    try:
+        with futures.ThreadPoolExecutor(max_workers=theMaxThreads) as threads:
+            list(threads.map(run, targets or ['default']))
+    except BuildError as e:
+        logger.error(e)
+        return e.returncode
+
+    for targetPath, script, reason in sorted(query.stale):
+        print('Make %s from %s because %s' % (path2str(targetPath, currentDir), script, reason))
+
+    return 1 if query.stale else 0
+
+
+# Commands given in place of targets, as "./make.sh --command args..."
+theCommands: Dict[str, Callable[[str, List[str]], int]] = {
+    '--cache-stats': artifactStats,
+    '--clean': cleanTargets,
+    '--import': importInfo,
+    '--watch': watchTargets,
+    '--why': queryTargets,
+    '--worker': serveWorker,
+    '--workers': localWorkers,
+}
 
 
 def main(argv: List[str] = sys.argv) -> int:
@@ -555,37 +4296,168 @@ def main(argv: List[str] = sys.argv) -> int:
     )
     logger.info('GoodMake version %s', theVersion)
 
+    if theHash not in theHashes:
+        logger.error('Unknown %s %s.  Use one of %s', theHashName, theHash, ', '.join(theHashes))
+        return 1
+
+    if len(argv) > 2 and reportChecked(argv):
+        return 0
+
+    # Nested builds may run in other directories
+    for name in [theArtifactsName, theDatabaseName, theTraceName]:
+        if os.environ.get(name):
+            os.environ[name] = path.abspath(os.environ[name])
+
+    command = theCommands.get(argv[3]) if len(argv) > 3 else None
+    if command:
+        return command(argv[2], argv[4:])
+
+    returncode = Daemon.forward(argv)
+    if returncode is not None:
+        return returncode
+
+    if theTimestampName in os.environ:
+        return build(argv)
+
+    with topLevel():
+        return build(argv)
+
+
+@contextmanager
+def topLevel() -> Generator:
+    """ Own the state shared with nested builds, for one top-level build. """
+    timestamp = os.environ[theTimestampName] = date2str(datetime.now())
+
+    with ExitStack() as stack:
+        if Trace.enabled():
+            stack.callback(Trace.merge, timestamp)
+
+        artifacts = Artifacts.fromEnv()
+        if artifacts is not None:
+            stack.callback(artifacts.evict)
+
+        # Remote workers can run more recipes than this machine
+        workers = WorkerPool.fromEnv()
+        slots = workers.slots() if workers else 0
+        jobs = JobServer.create(timestamp, max(theMaxThreads, 1 + slots))
+        stack.callback(jobs.remove)
+        stack.callback(Admission(timestamp).remove)
+
+        stack.callback(Memo.create(timestamp).remove)
+        os.environ[theJobServerName] = cast(str, jobs.fifoPath)
+
+        if env2bool(theDaemonName):
+            daemon = Daemon(timestamp)
+            daemon.start()
+            stack.callback(daemon.stop)
+
+        yield
+
+
+def reportChecked(argv: List[str]) -> bool:
+    """ Report the targets in argv to the parent GM_FILE, if all were checked this build.
+
+    Most nested invocations end this way, so this doesn't load the script
+    or start a Builder.  Returns False if the targets need a full build. """
+    memo = Memo(os.environ.get(theTimestampName))
+    if memo.dirPath is None:
+        return False
+
+    currentDir = os.getcwd()
+    commands = [BuildCommand(currentDir, argv[2], target) for target in argv[3:] or ['default']]
+    events = [memo.lookup(command) for command in commands]
+    if not all(events):
+        return False
+
+    Trace.startup()
+    depPath = parentJournal(currentDir)
+    for command, event in zip(commands, events):
+        logger.info(
+            'Skip %s from %s because it was checked this build', command.target, command.script
+        )
+        if depPath:
+            record(depPath, command, cast(BuildEvent, event))
+    return True
+
+
+def parentJournal(currentDir: FullPath) -> Optional[FullPath]:
+    """ The GM_FILE of the recipe that ran us, to record our targets in. """
+    depPath = cast(Optional[FullPath], os.environ.get(theDepName, None))
+
+    # A batch recipe records dependencies of one of its targets with GM_TARGET
+    if os.environ.get(theBatchName) and os.environ.get(theTargetName):
+        journals = json.loads(os.environ[theBatchName])
+        depPath = journals.get(str2path(os.environ[theTargetName], currentDir), depPath)
+    return depPath
+
+
+def record(depPath: FullPath, command: BuildCommand, event: BuildEvent) -> None:
+    logger.debug('Writing %s to parent %s', command.target, depPath)
+    with open(depPath, 'a') as file:
+        file.write(event.toString(path.dirname(depPath)) + '\n')
+
+
+def build(
+    argv: List[str],
+    scripts: Optional[Dict[FullPath, Script]] = None,
+    events: Optional[List[str]] = None,
+    builder: Optional[Builder] = None,
+) -> int:
+    """ Build the targets in argv, and write them to the parent GM_FILE. """
     # interpreter = argv[1]  # interpreter will be taken from the file shebang
     scriptPath = argv[2]
     targetPaths = argv[3:] or ['default']
-    depPath = cast(Optional[FullPath], os.environ.get(theDepName, None))
     currentDir = os.getcwd()
+    depPath = parentJournal(currentDir)
 
     logger.debug('PID %s:%s for %s', os.getpid(), os.getppid(), targetPaths)
+    Trace.startup()
+
+    if builder is None:
+        builder = AsyncBuilder(scripts) if env2bool(theAsyncName) else Builder(scripts)
 
-    builder = Builder()
+    def report(commands: List[BuildCommand], built: List[BuildEvent]) -> None:
+        for command, event in zip(commands, built):
+            if events is not None:
+                events.append(event.toString(currentDir))
+
+            if depPath:
+                record(depPath, command, event)
 
-    def runBuild(target: str) -> None:
+    def runBuild(commands: List[BuildCommand]) -> None:
         if Builder.error:
             return
         try:
-            command = BuildCommand(currentDir, scriptPath, target)
-            event = builder.build(command)
-
-            if depPath:
-                logger.debug('Writing %s to parent %s', target, depPath)
-                with open(depPath, 'a') as file:
-                    file.write(event.toString(path.dirname(depPath)) + '\n')
+            if len(commands) > 1:
+                report(commands, builder.buildBatch(commands))
+            else:
+                report(commands, [builder.build(commands[0])])
         except Exception as e:
             logger.debug("Setting %s thread error %s", os.getpid(), e)
-            Builder.error = e
-
-    if theMaxThreads <= 1 or len(targetPaths) <= 1:
-        for target in targetPaths:
-            runBuild(target)
+            Builder.fail(e)
+
+    commands = [BuildCommand(currentDir, scriptPath, target) for target in targetPaths]
+    if depPath is None and env2bool(thePrewarmName):
+        builder.prewarm(commands)
+
+    units = builder.batches(commands)
+
+    if len(units) > 1 and theMaxThreads > 1:
+        # Start the longest chains of recipes first.  Unknown targets keep their order, last.
+        expected = {
+            target: builder.expected(BuildCommand(currentDir, scriptPath, target))
+            for target in set(targetPaths)
+        }
+        units.sort(key=lambda unit: -max(expected[command.target] for command in unit))
+
+    if isinstance(builder, AsyncBuilder):
+        builder.buildAll(units, report)
+    elif theMaxThreads <= 1 or len(units) <= 1:
+        for unit in units:
+            runBuild(unit)
     else:
-        with ThreadPool(max_workers=theMaxThreads) as threads:
-            threads.map(runBuild, targetPaths)
+        with futures.ThreadPoolExecutor(max_workers=theMaxThreads) as threads:
+            threads.map(runBuild, units)
 
     if Builder.error:
         logger.error(Builder.error)
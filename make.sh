@@ -20,9 +20,13 @@
     $0 goodmake.py mypy.ini
     MYPYPATH=./stubs mypy goodmake.py
 
+#? !bench
+    $0 goodmake.py bench/startup.py
+    ./bench/startup.py
+
 #! !clean
     rm -rf test/results dist goodmake.egg-info
-    rm -f $(scripts/goodmake_clean.sh)
+    $0 --clean -f
 
 #! !test-pypi
     opts="-r pypitest"
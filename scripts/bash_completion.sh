@@ -16,6 +16,10 @@ _goodmake_targets()
 
     tgts=
     for pat in $pats; do
+        # Skip resources and options like +mem=4G or +batch
+        case "$pat" in
+            +*) continue ;;
+        esac
         tgts="$tgts ${pat#\!}"
     done
 
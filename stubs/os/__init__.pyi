@@ -1,13 +1,85 @@
 from .path import Path, FullPath
-from typing import AnyStr, MutableMapping, Generic
+from typing import AnyStr, Dict, List, Generic, Iterator, MutableMapping, NoReturn, Optional, Tuple
 
+O_RDONLY: int
+O_WRONLY: int
+O_RDWR: int
+O_CREAT: int
+O_NONBLOCK: int
+O_APPEND: int
+O_CLOEXEC: int
+SEEK_END: int
+POSIX_FADV_WILLNEED: int
+
+devnull: str
+pathsep: str
+sep: str
+
+def _exit(status: int) -> NoReturn: ...
+def chdir(fullPath: str) -> None: ...
+def chmod(fullPath: FullPath, mode: int) -> None: ...
+def close(fd: int) -> None: ...
+def cpu_count() -> Optional[int]: ...
+def dup(fd: int) -> int: ...
+def dup2(fd: int, fd2: int) -> int: ...
+def fork() -> int: ...
+def fstat(fd: int) -> stat_result: ...
+def ftruncate(fd: int, length: int) -> None: ...
 def getcwd() -> FullPath: ...
+def getloadavg() -> Tuple[float, float, float]: ...
 def getpid() -> int: ...
 def getppid() -> int: ...
+def getuid() -> int: ...
+def kill(pid: int, signal: int) -> None: ...
+def killpg(pgid: int, signal: int) -> None: ...
+def link(src: FullPath, dst: FullPath) -> None: ...
+def listdir(fullPath: FullPath) -> List[str]: ...
+def mkfifo(path: str, mode: int = 0o666) -> None: ...
 def makedirs(fullPath: FullPath, exist_ok: bool = False) -> None: ...
+def open(path: str, flags: int, mode: int = 0o777) -> int: ...
+def pidfd_open(pid: int, flags: int = 0) -> int: ...
+def pipe() -> Tuple[int, int]: ...
+def posix_fadvise(fd: int, offset: int, length: int, advice: int) -> None: ...
+def read(fd: int, n: int) -> bytes: ...
+def readlink(fullPath: FullPath) -> str: ...
+def waitpid(pid: int, options: int) -> Tuple[int, int]: ...
+def walk(top: str) -> Iterator[Tuple[str, List[str], List[str]]]: ...
+def write(fd: int, data: bytes) -> int: ...
 def remove(fullPath: FullPath) -> None: ...
+def replace(src: FullPath, dst: FullPath) -> None: ...
+def scandir(fullPath: FullPath) -> _ScandirIterator: ...
+def set_blocking(fd: int, blocking: bool) -> None: ...
+def stat(fullPath: FullPath) -> stat_result: ...
+def strerror(code: int) -> str: ...
+def sysconf(name: str) -> int: ...
+def urandom(size: int) -> bytes: ...
 def utime(fullPath: FullPath) -> None: ...
 
+class stat_result:
+    st_mode: int
+    st_ino: int
+    st_dev: int
+    st_nlink: int
+    st_uid: int
+    st_gid: int
+    st_size: int
+    st_atime: float
+    st_mtime: float
+    st_ctime: float
+    st_atime_ns: int
+    st_mtime_ns: int
+    st_ctime_ns: int
+
+class DirEntry:
+    name: str
+    path: str
+    def stat(self, follow_symlinks: bool = True) -> stat_result: ...
+
+class _ScandirIterator(Iterator[DirEntry]):
+    def __next__(self) -> DirEntry: ...
+    def __enter__(self) -> _ScandirIterator: ...
+    def __exit__(self, *args: object) -> None: ...
+
 class _Environ(MutableMapping[AnyStr, AnyStr], Generic[AnyStr]):
     def copy(self) -> Dict[AnyStr, AnyStr]: ...
     def __delitem__(self, key: AnyStr) -> None: ...
@@ -1,15 +1,18 @@
-from typing import NewType
+from typing import NewType, Tuple
 
 Path = NewType('Path', str)
 FullPath = NewType('FullPath', Path)
 
+def abspath(path: str) -> FullPath: ...
 def basename(path: str) -> str: ...
 def dirname(fullPath: FullPath) -> FullPath: ...
+def expanduser(path: str) -> str: ...
 def exists(fullPath: FullPath) -> bool: ...
 def getmtime(fullPath: FullPath) -> float: ...
 def getsize(fullPath: FullPath) -> int: ...
 def isdir(fullPath: FullPath) -> bool: ...
-def join(dirPath: FullPath, realpath: str) -> FullPath: ...
+def join(dirPath: FullPath, *paths: str) -> FullPath: ...
 def normpath(fullPath: FullPath) -> FullPath: ...
 def realpath(fullPath: FullPath) -> FullPath: ...
 def relpath(fullPath: FullPath, dirPath: FullPath) -> str: ...
+def split(fullPath: FullPath) -> Tuple[FullPath, str]: ...
@@ -27,6 +27,31 @@
 #? circular-b
     $0 circular-a
 
+#? circular-c
+    $0 circular-d
+
+#? circular-d
+    $0 circular-c
+
+#? tgt/listing
+    $0 src/dir
+    cat $(find src/dir -type f | sort) > $1
+
+#? tgt/*.batch +batch
+    for t; do
+        GM_TARGET=$t $0 src/input.txt
+    done
+    echo "Batch $*"
+    for t; do
+        sort src/input.txt > $t
+    done
+
+#? tgt/group.c tgt/group.h +group
+    $0 src/input.txt
+    echo "Group $*"
+    sort src/input.txt > $1
+    sort src/input.txt > $2
+
 #? tgt/conflict
     echo $0>$1
 
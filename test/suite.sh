@@ -3,11 +3,16 @@
 #? !default
     $0 results/example
     $0 results/simple
+    $0 results/why
+    $0 results/batch
     $0 results/python
     $0 results/dotfile
+    $0 results/directory
     $0 results/parallel
+    $0 results/circular
     $0 results/errors
     $0 results/missing
+    $0 results/clean
     $0 results/every
     $0 results/fake
     $0 results/conflict
@@ -44,6 +49,22 @@
     echo "alfred" >> src/input.txt
     $DIR/make.sh tgt/sorted.txt
 
+#? results/why
+    $DIR/make.sh --why tgt/sorted.txt || echo "Error#" $?
+    $DIR/make.sh --why src/nothing.txt || echo "Error#" $?
+    $DIR/make.sh tgt/sorted.txt
+    $DIR/make.sh --why tgt/sorted.txt
+    echo "alfred" >> src/input.txt
+    $DIR/make.sh --why tgt/sorted.txt || echo "Error#" $?
+
+#? results/batch
+    $DIR/make.sh tgt/a.batch tgt/b.batch
+    $DIR/make.sh tgt/a.batch tgt/b.batch tgt/c.batch
+    echo "alfred" >> src/input.txt
+    $DIR/make.sh tgt/a.batch tgt/b.batch tgt/c.batch
+    $DIR/make.sh tgt/group.h
+    $DIR/make.sh tgt/group.c tgt/group.h
+
 #? results/python
     $DIR/make.py tgt/sorted.txt
 
@@ -51,6 +72,15 @@
     $DIR/make.sh tgt/usedot
     $DIR/make.sh tgt/usedot
 
+#? results/directory
+    mkdir -p src/dir/sub
+    echo "one" > src/dir/sub/file.txt
+    $DIR/make.sh tgt/listing
+    touch src/dir/sub/file.txt
+    $DIR/make.sh tgt/listing
+    echo "two" > src/dir/sub/file.txt
+    $DIR/make.sh tgt/listing
+
 #? results/parallel
     set +x
     export GM_THREADS=8
@@ -59,7 +89,8 @@
     done | { set -x; xargs $DIR/make.sh; }
 
 #? results/circular
-    $DIR/make.sh circular-a
+    $DIR/make.sh circular-a || echo "Error#" $?
+    $DIR/make.sh circular-c || echo "Error#" $?
 
 #! !results/ctlc
     # This gives you an opportunity to hit ctl-c and see what happens
@@ -73,6 +104,14 @@
 #? results/missing
     $DIR/make.sh no_recipe || echo "Error #" $?
 
+#? results/clean
+    rm -rf tgt
+    $DIR/make.sh tgt/sorted.txt tgt/usedot
+    $DIR/make.sh --clean tgt
+    touch -d "1 hour" tgt/sorted.txt
+    $DIR/make.sh --clean -f tgt
+    ls -A tgt
+
 #? results/parallel results/errors
     # We can't depend on the sequence
     sort $1 > $1.tmp